@@ -1,11 +1,29 @@
+import atexit
 import contextlib
+import functools
+import hashlib
+import io
+import multiprocessing
 import os
+import sys
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
 import xml.etree.ElementTree as ET
 from collections import defaultdict
 import re
-from typing import Dict, List, Tuple, Union
-from xml.dom.minidom import Document
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import lovely_logger as logging  # type: ignore
 import numpy as np  # type: ignore
@@ -15,11 +33,19 @@ import requests  # type: ignore
 import streamlit as st  # type: ignore
 from pandas import read_csv
 from scipy import stats  # type: ignore
-from shapely.geometry import LineString, Point, Polygon  # type: ignore
+from shapely.geometry import Polygon  # type: ignore
 
 # shapely.geometry.polygon.orient
 from sklearn.neighbors import KDTree  # type: ignore
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None  # type: ignore
+
+if TYPE_CHECKING:
+    from data_structure import AgentIndex, FrameIndex, GridBins, SegmentGrid
+
 # name
 # trajectory
 # geometry
@@ -124,12 +150,74 @@ def download(url: str, filename: str):
         )
 
 
+def fingerprint(stream: BinaryIO, chunk_size: int = 1 << 20) -> str:
+    """Return BLAKE2 digest of a binary stream
+
+    The stream is hashed in chunks of chunk_size bytes from the beginning
+    and rewound afterwards.
+    """
+
+    digest = hashlib.blake2b(digest_size=20)
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        digest.update(chunk)
+
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+# digests of uploaded files by (upload id, size)
+_upload_digests: Dict[Tuple[int, int], str] = {}
+
+
+def upload_fingerprint(uploaded_file) -> str:
+    """Return fingerprint of an uploaded file, hashed once per upload"""
+
+    key = (uploaded_file.id, uploaded_file.size)
+    if key not in _upload_digests:
+        if len(_upload_digests) >= 64:
+            _upload_digests.clear()
+
+        _upload_digests[key] = fingerprint(uploaded_file)
+
+    return _upload_digests[key]
+
+
+@functools.lru_cache(maxsize=64)
+def _file_fingerprint(path: str, mtime_ns: int, size: int) -> str:
+    with open(path, "rb") as f:
+        return fingerprint(f)
+
+
+def file_fingerprint(path: str) -> str:
+    """Return fingerprint of a file, hashed again only if it was modified"""
+
+    stat = os.stat(path)
+    return _file_fingerprint(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def peak_rss() -> float:
+    """Peak resident set size of the process in MB (0 if unknown)"""
+
+    if resource is None:
+        return 0.0
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return rss / 1024**2 if sys.platform == "darwin" else rss / 1024
+
+
 @contextlib.contextmanager
 def profile(name: str):
+    """Log runtime of the block and the entries of the yielded dict"""
     start_time = time.time()
-    yield  # <-- your code will execute here
+    stats: Dict[str, float] = {}
+    yield stats  # <-- your code will execute here
     total_time = time.time() - start_time
-    logging.info(f"{name}: {total_time * 1000.0:.4f} ms")
+    details = ", ".join(f"{key}: {value:.4g}" for key, value in stats.items())
+    logging.info(
+        f"{name}: {total_time * 1000.0:.4f} ms" + (f" ({details})" if details else "")
+    )
 
 
 def weidmann(
@@ -153,10 +241,13 @@ def inv_weidmann(
     rho_max: float = 5.4,
     gamma: float = 1.913,
 ) -> npt.NDArray[np.float64]:
-    """Weidmann velocity function"""
+    """Weidmann velocity function
+
+    Speeds above v0 are clipped to v0. v is not modified, so it can be a
+    view of the read-only trajectory data.
+    """
 
-    v[v > v0] = v0
-    s = 1 - v / v0
+    s = 1 - np.minimum(v, v0) / v0
     # np.log(s, where=np.logical_not(zero_mask))
     x = -1 / gamma * np.log(s, out=np.zeros_like(s), where=s != 0) + 1 / rho_max
     return np.array(1 / x)
@@ -192,6 +283,11 @@ def get_fps(line: str):
 
     pattern = r"#\s*framerate:\s*(\d+)(?:\s*fps)?"
     match = re.search(pattern, line)
+    if match is None:
+        st.error("No framerate found in header")
+        logging.error("No framerate found in header")
+        st.stop()
+
     fps = match.group(1)
     try:
         fps_int = int(float(fps))
@@ -248,73 +344,6 @@ def get_unit(traj_file: str) -> str:
     return unit
 
 
-def get_transitions(xml_doc: Document, unit: str) -> Dict[int, npt.NDArray[np.float64]]:
-    if unit == "cm":
-        cm2m = 100
-    else:
-        cm2m = 1
-
-    transitions = {}
-    for _, t_elem in enumerate(xml_doc.getElementsByTagName("transition")):
-        Id = t_elem.getAttribute("id")
-        n_vertex = len(t_elem.getElementsByTagName("vertex"))
-        vertex_array = np.zeros((n_vertex, 2))
-        for v_num, _ in enumerate(t_elem.getElementsByTagName("vertex")):
-            vertex_array[v_num, 0] = (
-                t_elem.getElementsByTagName("vertex")[v_num].attributes["px"].value
-            )
-            vertex_array[v_num, 1] = (
-                t_elem.getElementsByTagName("vertex")[v_num].attributes["py"].value
-            )
-
-        transitions[Id] = vertex_array / cm2m
-
-    return transitions
-
-
-def get_measurement_lines(
-    xml_doc: Document, unit: str
-) -> Dict[int, npt.NDArray[np.float64]]:
-    """add area_L
-
-    https://www.jupedsim.org/jpsreport_inifile#measurement-area
-    """
-
-    if unit == "cm":
-        cm2m = 100
-    else:
-        cm2m = 1
-
-    fake_id = 1000
-    measurement_lines = {}
-    for _, t_elem in enumerate(xml_doc.getElementsByTagName("area_L")):
-        Id = t_elem.getAttribute("id")
-        logging.info(f"Measurement id = <{Id}>")
-        if Id == "":
-            st.warning(f"Got Measurement line with no Id. Setting id = {fake_id}")
-            logging.info(f"Got Measurement line with no Id. Setting id = {fake_id}")
-            Id = fake_id
-            fake_id += 1
-
-        n_vertex = 2
-        vertex_array = np.zeros((n_vertex, 2))
-        vertex_array[0, 0] = (
-            t_elem.getElementsByTagName("start")[0].attributes["px"].value
-        )
-        vertex_array[0, 1] = (
-            t_elem.getElementsByTagName("start")[0].attributes["py"].value
-        )
-        vertex_array[1, 0] = (
-            t_elem.getElementsByTagName("end")[0].attributes["px"].value
-        )
-        vertex_array[1, 1] = (
-            t_elem.getElementsByTagName("end")[0].attributes["py"].value
-        )
-        measurement_lines[Id] = vertex_array / cm2m
-        logging.info(f"vertex: {vertex_array}")
-    return measurement_lines
-
-
 # def passing_frame(
 #     ped_data: np.array, line: LineString, fps: int, max_distance: float
 # ) -> int:
@@ -366,179 +395,371 @@ def get_measurement_lines(
 #     # print("Crossed?", crossed_line)
 
 
-def on_different_sides(
-    L1: npt.NDArray[np.float64],
-    L2: npt.NDArray[np.float64],
-    P1: npt.NDArray[np.float64],
-    P2: npt.NDArray[np.float64],
-) -> bool:
-    """True is P1 and P2 are on different sides from [L1, L2]
-
-                        L1
-                        x
-                        |
-                        |
-                  P1 x  |     x P2
-                        x
-                        L2
-    --> True
-    """
+def distance_to_line(
+    points: npt.NDArray[np.float64], line: npt.NDArray[np.float64]
+) -> npt.NDArray[np.float64]:
+    """Euclidean distance of points (n x 2) to the polyline line (m x 2)
 
-    sign1 = np.cross(L1 - L2, L1 - P1)
-    sign2 = np.cross(L1 - L2, L1 - P2)
-    return bool(np.sign(sign1) != np.sign(sign2))
+    Same as shapely Point.distance(LineString), for all points at once.
+    """
 
+    distance = np.full(len(points), np.inf)
+    for a, b in zip(line[:-1], line[1:]):
+        ab = b - a
+        length2 = ab @ ab
+        ap = points - a
+        if length2 > 0:
+            t = np.clip(ap @ ab / length2, 0, 1)
+            ap -= t[:, np.newaxis] * ab
 
-def passing_frame(
-    ped_data: npt.NDArray[np.float64], line: LineString, fps: float
-) -> Tuple[int, int]:
-    """First frame at which the pedestrian is within a buffer around line
+        np.minimum(distance, np.hypot(ap[:, 0], ap[:, 1]), out=distance)
 
-    fps is used to determin the width of the buffer and is not needed
-    in the calculations.
-    Assume a desired speed of 1.3 m/s
+    return distance
 
 
+def crossing_events(
+    data: npt.NDArray[np.float64],
+    agents: "AgentIndex",
+    lines: List[npt.NDArray[np.float64]],
+    grid: Optional["SegmentGrid"] = None,
+    stats: Optional[Dict[str, float]] = None,
+    segments: Optional[List[npt.NDArray[np.int64]]] = None,
+) -> npt.NDArray[np.float64]:
+    """Return all crossings of the trajectories with lines
+
+    Every two consecutive rows of an agent form a segment, which is tested
+    against all lines at once. An agent crossing a line several times
+    produces several events.
+
+    :param data: trajectories sorted by (ID, FR). 2D array
+    :param agents: index of the rows of each agent in data
+    :param lines: lines given by their first two vertices
+    :param grid: if given, only segments near a line are tested
+    :param stats: if given, filled with the number of tested segments
+    :param segments: if given, the sorted candidate segments of each line,
+        e.g. from grid.query. Used instead of grid
+    :returns: one row per crossing, sorted by (line, time) with columns
+        agent, frame (last frame before the crossing), line (index in lines),
+        direction (+1/-1), time (interpolated crossing time in frames)
+
+    The direction is the sign of cross(L2 - L1, P(f+1) - P(f)).
     """
-    XY: npt.NDArray[np.float64] = ped_data[:, 2:4]
-    L1: npt.NDArray[np.float64] = np.array(line.coords[0])
-    L2: npt.NDArray[np.float64] = np.array(line.coords[1])
-    P1: npt.NDArray[np.float64] = XY[0]
-    P2: npt.NDArray[np.float64] = XY[-1]
-    i1 = 0  # index of first element
-    i2 = len(XY) - 1  # index of last element
-    im = int(len(XY) / 2)  # index of the element in the middle
-    M = XY[im]
-    i = 0
-    passed_line_at_frame: int = -1
-    sign: int = -1
-    if not on_different_sides(L1, L2, P1, P2):
-        return passed_line_at_frame, sign
-
-    while i1 + 1 < i2 and i < 20:
-        i += 1  # to avoid endless loops! Should be removed!
-        if on_different_sides(L1, L2, M, P2):
-            P1 = M
-            i1 = im
+
+    xy = data[:, 2:4]
+    events = [np.empty((0, 5))]
+    tested = 0
+    if grid is None and segments is None:
+        x = np.ascontiguousarray(xy[:, 0])
+        y = np.ascontiguousarray(xy[:, 1])
+        # segments connecting rows of the same agent
+        same_agent = np.ones(max(len(data) - 1, 0), dtype=bool)
+        same_agent[agents.offsets[1:-1] - 1] = False
+        # buffers reused for all lines
+        side = np.empty(len(data))
+        tmp = np.empty(len(data))
+        right = np.empty(len(data), dtype=bool)
+        changed = np.empty(len(same_agent), dtype=bool)
+
+    for k, line in enumerate(lines):
+        L1 = np.asarray(line[0], dtype=np.float64)
+        L2 = np.asarray(line[1], dtype=np.float64)
+        d = L2 - L1
+        # side = cross(d, P - L1): > 0 left of the line, < 0 right of it
+        if segments is not None:
+            seg = segments[k]
+            tested += len(seg)
+        elif grid is not None:
+            seg = grid.query(np.minimum(L1, L2), np.maximum(L1, L2))
+            tested += len(seg)
         else:
-            P2 = M
-            i2 = im
+            np.multiply(y, d[0], out=side)
+            np.multiply(x, d[1], out=tmp)
+            side -= tmp
+            side -= d[0] * L1[1] - d[1] * L1[0]
+            np.less(side, 0, out=right)
+            np.not_equal(right[:-1], right[1:], out=changed)
+            changed &= same_agent
+            seg = np.flatnonzero(changed)
+            tested += len(data) - len(agents)
+
+        s0 = d[0] * (xy[seg, 1] - L1[1]) - d[1] * (xy[seg, 0] - L1[0])
+        s1 = d[0] * (xy[seg + 1, 1] - L1[1]) - d[1] * (xy[seg + 1, 0] - L1[0])
+        crossed = (s0 < 0) != (s1 < 0)
+        seg, s0, s1 = seg[crossed], s0[crossed], s1[crossed]
+
+        t = s0 / (s0 - s1)
+        # crossing point must be on the line, not on its extension
+        point = xy[seg] + t[:, np.newaxis] * (xy[seg + 1] - xy[seg])
+        u = (point - L1) @ d / (d @ d)
+        hit = (u >= 0) & (u <= 1)
+        seg = seg[hit]
+        frame0 = data[seg, 1]
+        frame1 = data[seg + 1, 1]
+        events.append(
+            np.column_stack(
+                (
+                    data[seg, 0],
+                    frame0,
+                    np.full(len(seg), k),
+                    np.sign(s1[hit] - s0[hit]),
+                    frame0 + t[hit] * (frame1 - frame0),
+                )
+            )
+        )
 
-        im = int((i1 + i2) / 2)
-        M = XY[im]
+    events = np.vstack(events)
+    if stats is not None:
+        num_segments = max(len(data) - len(agents), 1) * max(len(lines), 1)
+        stats["candidates"] = tested / num_segments
+        stats["hit ratio"] = len(events) / max(tested, 1)
 
-    # this is to ensure, that the pedestrian really passed *through* the line
-    line_buffer = line.buffer(1.3 / fps, cap_style=2)
-    if Point(XY[i1]).within(line_buffer):
-        passed_line_at_frame = ped_data[i1, 1]
-        sign = int(np.sign(np.cross(L1 - L2, XY[i1] - XY[i2])))
-    elif Point(XY[i2]).within(line_buffer):
-        passed_line_at_frame = ped_data[i2, 1]
-        sign = int(np.sign(np.cross(L1 - L2, XY[i1] - XY[i2])))
+    return events[np.lexsort((events[:, 4], events[:, 2]))]
 
-    return passed_line_at_frame, sign
 
+def _crossing_events_shard(
+    shm_name: str,
+    shape: Tuple[int, int],
+    dtype: str,
+    rows: slice,
+    agents: "AgentIndex",
+    lines: List[npt.NDArray[np.float64]],
+    segments: Optional[List[npt.NDArray[np.int64]]] = None,
+) -> npt.NDArray[np.float64]:
+    """crossing_events in a worker process on rows of the shared data"""
 
-def read_trajectory(input_file: str) -> npt.NDArray[np.float64]:
-    data = read_csv(input_file, sep=r"\s+", dtype=np.float64, comment="#").values
-    return np.array(data)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[rows]
+        events = crossing_events(data, agents, lines, segments=segments)
+        # the view must be released before closing the shared memory
+        del data
+        return events
+    finally:
+        shm.close()
+
+
+# one worker pool and the shared copy of the last dataset, kept for later
+# calls. Both are only used while holding _workers_lock
+_workers_lock = threading.Lock()
+_executor: Dict[int, ProcessPoolExecutor] = {}
+_shared_data: Dict[Hashable, shared_memory.SharedMemory] = {}
+
+
+def _get_executor(workers: int) -> ProcessPoolExecutor:
+    """Pool with workers processes, replacing a pool of another size"""
+
+    if workers not in _executor:
+        for pool in _executor.values():
+            pool.shutdown(wait=False)
+
+        _executor.clear()
+        # fork is unsafe in the threaded streamlit server
+        method = (
+            "forkserver"
+            if "forkserver" in multiprocessing.get_all_start_methods()
+            else "spawn"
+        )
+        _executor[workers] = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context(method)
+        )
 
+    return _executor[workers]
 
-def read_obstacle(xml_doc: Document, unit: str) -> Dict[int, npt.NDArray[np.float64]]:
-    if unit == "cm":
-        cm2m = 100
-    else:
-        cm2m = 1
-
-    # Initialization of a dictionary with obstacles
-    return_dict = {}
-    # read in obstacles and combine
-    # them into an array for polygon representation
-    points = np.zeros((0, 2))
-    for o_num, o_elem in enumerate(xml_doc.getElementsByTagName("obstacle")):
-        N_polygon = len(o_elem.getElementsByTagName("polygon"))
-        if N_polygon == 1:
-            pass
-        else:
-            points = np.zeros((0, 2))
 
-        for _, p_elem in enumerate(o_elem.getElementsByTagName("polygon")):
-            for _, v_elem in enumerate(p_elem.getElementsByTagName("vertex")):
-                vertex_x = float(
-                    # p_elem.getElementsByTagName("vertex")[v_num].attributes["px"].value
-                    v_elem.attributes["px"].value
-                )
-                vertex_y = float(
-                    # p_elem.getElementsByTagName("vertex")[v_num].attributes["py"].value
-                    v_elem.attributes["py"].value
-                )
-                points = np.vstack([points, [vertex_x / cm2m, vertex_y / cm2m]])
-
-        points = np.unique(points, axis=0)
-        x = points[:, 0]
-        y = points[:, 1]
-        n = len(points)
-        center_point = [np.sum(x) / n, np.sum(y) / n]
-        angles = np.arctan2(x - center_point[0], y - center_point[1])
-        # sorting the points:
-        sort_tups = sorted(list(zip(x, y, angles)), key=lambda t: t[2])  # type: ignore
-        return_dict[o_num] = np.array(sort_tups)[:, 0:2]
-
-    return return_dict
-
-
-def read_subroom_walls(
-    xml_doc: Document, unit: str
-) -> Dict[int, npt.NDArray[np.float64]]:
-    dict_polynom_wall = {}
-    n_wall = 0
-    if unit == "cm":
-        cm2m = 100
-    else:
-        cm2m = 1
-
-    for _, s_elem in enumerate(xml_doc.getElementsByTagName("subroom")):
-        for _, p_elem in enumerate(s_elem.getElementsByTagName("polygon")):
-            # if p_elem.getAttribute("caption") == "wall":
-            n_wall = n_wall + 1
-            n_vertex = len(p_elem.getElementsByTagName("vertex"))
-            vertex_array = np.zeros((n_vertex, 2))
-            for v_num, _ in enumerate(p_elem.getElementsByTagName("vertex")):
-                vertex_array[v_num, 0] = (
-                    p_elem.getElementsByTagName("vertex")[v_num].attributes["px"].value
-                )
-                vertex_array[v_num, 1] = (
-                    p_elem.getElementsByTagName("vertex")[v_num].attributes["py"].value
-                )
+def _release_shared_data() -> None:
+    """Remove the shared copies of the data"""
+
+    for shm in _shared_data.values():
+        shm.close()
+        shm.unlink()
+
+    _shared_data.clear()
+
+
+def _get_shared_data(
+    data: npt.NDArray[np.float64], dataset: Hashable
+) -> shared_memory.SharedMemory:
+    """Shared copy of data, created once per dataset"""
+
+    shm = _shared_data.get(dataset)
+    if shm is None:
+        _release_shared_data()
+        shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+        shared[:] = data
+        del shared
+        _shared_data[dataset] = shm
+
+    return shm
 
-            dict_polynom_wall[n_wall] = vertex_array / cm2m
 
-    return dict_polynom_wall
+@atexit.register
+def _shutdown_workers() -> None:
+    """Stop the worker pool and remove the shared data"""
+
+    with _workers_lock:
+        for pool in _executor.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        _executor.clear()
+        _release_shared_data()
+
+
+def crossing_events_parallel(
+    data: npt.NDArray[np.float64],
+    agents: "AgentIndex",
+    lines: List[npt.NDArray[np.float64]],
+    workers: int,
+    lines_per_task: int = 8,
+    grid: Optional["SegmentGrid"] = None,
+    dataset: Hashable = None,
+) -> npt.NDArray[np.float64]:
+    """crossing_events with agents and lines split over worker processes
+
+    The data is copied into shared memory, which the workers map instead
+    of receiving a pickled copy. With a dataset key the copy is kept until
+    the next dataset, otherwise it is removed after the call.
+    With a grid, every task only tests the segments of its agents near
+    its lines. Falls back to crossing_events in this process if
+    workers < 2 or the pool can not be used.
+
+    The workers are started with forkserver (or spawn) and import the main
+    module of the caller. A script calling this function at import time,
+    without an ``if __name__ == "__main__":`` guard, kills the pool
+    ("process terminated abruptly") and the crossings are calculated
+    serially with only a warning in the log.
+    """
+
+    if workers < 2 or len(agents) < 2 or not lines:
+        return crossing_events(data, agents, lines, grid)
 
+    # shards of agents with about the same number of rows
+    cuts = np.searchsorted(
+        agents.offsets, np.linspace(0, len(data), workers + 1), side="right"
+    )
+    cuts = np.unique(np.clip(cuts - 1, 0, len(agents)))
+    cuts[-1] = len(agents)
+    groups = range(0, len(lines), lines_per_task)
+    candidates = None
+    if grid is not None:
+        candidates = [
+            grid.query(np.min(line[:2], axis=0), np.max(line[:2], axis=0))
+            for line in lines
+        ]
+
+    with _workers_lock:
+        try:
+            if dataset is None:
+                shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+                shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+                shared[:] = data
+                del shared
+            else:
+                shm = _get_shared_data(data, dataset)
+        except OSError as e:
+            logging.warning(f"No shared memory, calculate crossings serially: {e}")
+            return crossing_events(data, agents, lines, grid)
+
+        try:
+            pool = _get_executor(workers)
+            futures = {}
+            for a0, a1 in zip(cuts[:-1], cuts[1:]):
+                first, last = agents.offsets[a0], agents.offsets[a1]
+                shard = type(agents)(
+                    agents.ids[a0:a1], agents.offsets[a0 : a1 + 1] - first
+                )
+                for g in groups:
+                    segments = None
+                    if candidates is not None:
+                        # sorted candidates of the rows of this shard
+                        segments = [
+                            c[np.searchsorted(c, first) : np.searchsorted(c, last)]
+                            - first
+                            for c in candidates[g : g + lines_per_task]
+                        ]
+                        if not any(len(s) for s in segments):
+                            continue
+
+                    future = pool.submit(
+                        _crossing_events_shard,
+                        shm.name,
+                        data.shape,
+                        data.dtype.str,
+                        slice(first, last),
+                        shard,
+                        lines[g : g + lines_per_task],
+                        segments,
+                    )
+                    futures[future] = g
+
+            parts = [np.empty((0, 5))]
+            for future, g in futures.items():
+                part = future.result()
+                part[:, 2] += g
+                parts.append(part)
+        except (OSError, BrokenProcessPool) as e:
+            logging.warning(f"Worker pool failed, calculate crossings serially: {e}")
+            for pool in _executor.values():
+                pool.shutdown(wait=False, cancel_futures=True)
+
+            _executor.clear()
+            _release_shared_data()
+            return crossing_events(data, agents, lines, grid)
+        finally:
+            if dataset is None:
+                shm.close()
+                shm.unlink()
+
+    events = np.vstack(parts)
+    return events[np.lexsort((events[:, 4], events[:, 2]))]
+
+
+def read_trajectory(
+    input_file: Union[str, BinaryIO],
+    chunk_rows: int = 1 << 18,
+    dtype: npt.DTypeLike = np.float64,
+) -> npt.NDArray[np.float64]:
+    """Parse trajectory file block-wise into one preallocated array
 
-def geo_limits(geo_xml: Document, unit: str) -> Tuple[float, float, float, float]:
-    """Return bounding box coordinates"""
+    The array is sized by a first pass counting the lines, then filled with
+    chunk_rows rows at a time, so besides the result at most one parsed
+    chunk is held in memory.
+    """
 
-    geometry_wall = read_subroom_walls(geo_xml, unit)
-    geominX = 1000
-    geomaxX = -1000
-    geominY = 1000
-    geomaxY = -1000
-    Xmin = []
-    Ymin = []
-    Xmax = []
-    Ymax = []
-    for _, wall in geometry_wall.items():
-        Xmin.append(np.min(wall[:, 0]))
-        Ymin.append(np.min(wall[:, 1]))
-        Xmax.append(np.max(wall[:, 0]))
-        Ymax.append(np.max(wall[:, 1]))
+    if isinstance(input_file, str):
+        with open(input_file, "rb") as f:
+            return read_trajectory(f, chunk_rows, dtype)
 
-    geominX = np.min(Xmin)
-    geomaxX = np.max(Xmax)
-    geominY = np.min(Ymin)
-    geomaxY = np.max(Ymax)
-    return geominX, geomaxX, geominY, geomaxY
+    start_time = time.time()
+    stream = input_file
+    stream.seek(0)
+    max_rows = 1
+    for block in iter(lambda: stream.read(1 << 20), b""):
+        max_rows += block.count(b"\n")
+
+    stream.seek(0)
+    data = np.empty((0, 0))
+    num_rows = 0
+    with read_csv(
+        stream, sep=r"\s+", dtype=np.float64, comment="#", chunksize=chunk_rows
+    ) as reader:
+        for chunk in reader:
+            values = chunk.to_numpy()
+            if not data.size:
+                data = np.empty((max_rows, values.shape[1]), dtype=dtype)
+
+            data[num_rows : num_rows + len(values)] = values
+            num_rows += len(values)
+
+    stream.seek(0)
+    total_time = time.time() - start_time
+    logging.info(
+        f"Read {num_rows} rows in {total_time:.2f} s "
+        f"({num_rows / max(total_time, 1e-9):.0f} rows/s), "
+        f"peak RSS {peak_rss():.0f} MB"
+    )
+    # the overestimate is only the number of comment lines
+    return data[:num_rows]
 
 
 def get_geometry_file(traj_file: str) -> str:
@@ -622,7 +843,7 @@ def touch_default_geometry_file(
 
 
 def compute_speed(
-    data: npt.NDArray[np.float64], fps: int, df: int = 10
+    data: npt.NDArray[np.float64], agents: "AgentIndex", fps: int, df: int = 10
 ) -> npt.NDArray[np.float64]:
     """Calculates the speed and the angle from the trajectory points.
 
@@ -631,7 +852,8 @@ def compute_speed(
     note: The last df frames are not calculated using [1].
     It is assumes that the speed in the last frames
     does not change
-    :param traj: trajectory of ped (x, y). 2D array
+    :param data: trajectories sorted by (ID, FR). 2D array
+    :param agents: index of the rows of each agent in data
     :param df: number of frames forwards
     :param fps: frames per seconds
 
@@ -649,11 +871,10 @@ def compute_speed(
     └────────►   *       *
                    *       *
     """
-    agents = np.unique(data[:, 0]).astype(int)
     once = 1
     speeds = np.array([])
-    for agent in agents:
-        ped = data[data[:, 0] == agent]
+    for _, rows in agents:
+        ped = data[rows]
         traj = ped[:, 2:4]
         size = traj.shape[0]
         speed = np.ones(size)
@@ -684,7 +905,9 @@ def compute_speed(
     return speeds
 
 
-def compute_speed_and_angle(data: npt.NDArray[np.float64], fps: int, df: int = 10):
+def compute_speed_and_angle(
+    data: npt.NDArray[np.float64], agents: "AgentIndex", fps: int, df: int = 10
+):
     """Calculates the speed and the angle from the trajectory points.
 
     Using the forward formula
@@ -692,11 +915,15 @@ def compute_speed_and_angle(data: npt.NDArray[np.float64], fps: int, df: int = 1
     note: The last df frames are not calculated using [1].
     It is assumes that the speed in the last frames
     does not change
-    :param traj: trajectory of ped (x, y). 2D array
+    :param data: trajectories sorted by (ID, FR). 2D array
+    :param agents: index of the rows of each agent in data
     :param df: number of frames forwards
     :param fps: frames per seconds
 
-    :returns: speed, angle
+    :returns: data with two additional columns: angle, speed (same dtype)
+
+    All agents are processed in one pass over the sorted data and the
+    result is written into one preallocated array.
 
     example:
     df=4, S=10
@@ -710,52 +937,47 @@ def compute_speed_and_angle(data: npt.NDArray[np.float64], fps: int, df: int = 1
     └────────►   *       *
                    *       *
     """
-    agents = np.unique(data[:, 0]).astype(int)
-    once = 1
-    data2 = np.array([])
-    for agent in agents:
-        ped = data[data[:, 0] == agent]
-        traj = ped[:, 2:4]
-        size = traj.shape[0]
-        speed = np.ones(size)
-        angle = np.zeros(size)
-
-        if size < df:
-            logging.warning(
-                f"""Compute_speed_and_angle() The number of frames used to calculate the speed {df}
-                exceeds the total amount of frames ({size}) for pedestrian {agent}"""
-            )
-            st.error(
-                f"""Compute_speed_and_angle() The number of frames used to calculate the speed {df}
-                exceeds the total amount of frames ({size}) for pedestrian {agent}"""
-            )
-        else:
-            delta = traj[df:, :] - traj[: size - df, :]
-            delta_x = delta[:, 0]
-            delta_y = delta[:, 1]
-
-            delta_square = np.square(delta)
-            delta_x_square = delta_square[:, 0]
-            delta_y_square = delta_square[:, 1]
-            angle[: size - df] = np.arctan2(delta_y, delta_x) * 180 / np.pi
-
-            s = np.sqrt(delta_x_square + delta_y_square)
-            speed[: size - df] = s / df * fps
-            speed[size - df :] = speed[size - df - 1]
-            angle[size - df :] = angle[size - df - 1]
-
-        ped = np.hstack((ped, angle.reshape(size, 1)))
-        ped = np.hstack((ped, speed.reshape(size, 1)))
-        if once:
-            data2 = ped
-            once = 0
-        else:
-            data2 = np.vstack((data2, ped))
+    num_rows, num_cols = data.shape
+    data2 = np.empty((num_rows, num_cols + 2), dtype=data.dtype)
+    data2[:, :num_cols] = data
+    angle = data2[:, num_cols]
+    speed = data2[:, num_cols + 1]
+    # forward difference for all rows at once. Rows less than df frames
+    # before the end of their agent are overwritten below
+    if num_rows > df:
+        delta = data[df:, 2:4] - data[: num_rows - df, 2:4]
+        angle[: num_rows - df] = np.arctan2(delta[:, 1], delta[:, 0]) * 180 / np.pi
+        speed[: num_rows - df] = np.hypot(delta[:, 0], delta[:, 1]) / df * fps
+        del delta
+
+    # tail: the last df rows of each agent get the last calculated value
+    starts = agents.offsets[:-1]
+    ends = agents.offsets[1:]
+    sizes = ends - starts
+    tail_from = np.maximum(ends - df, starts)
+    tail_len = ends - tail_from
+    tail = np.arange(np.sum(tail_len)) + np.repeat(
+        tail_from - (np.cumsum(tail_len) - tail_len), tail_len
+    )
+    short = np.repeat(sizes <= df, tail_len)
+    source = np.where(short, tail, np.repeat(ends - df - 1, tail_len))
+    angle[tail] = np.where(short, 0, angle[source])
+    speed[tail] = np.where(short, 1, speed[source])
+
+    for agent, size in zip(agents.ids[sizes < df], sizes[sizes < df]):
+        logging.warning(
+            f"""Compute_speed_and_angle() The number of frames used to calculate the speed {df}
+            exceeds the total amount of frames ({size}) for pedestrian {agent}"""
+        )
+        st.error(
+            f"""Compute_speed_and_angle() The number of frames used to calculate the speed {df}
+            exceeds the total amount of frames ({size}) for pedestrian {agent}"""
+        )
 
     return data2
 
 
-def calculate_speed_average(
+def binned_statistic(
     geominX: float,
     geomaxX: float,
     geominY: float,
@@ -764,23 +986,50 @@ def calculate_speed_average(
     dy: float,
     X: npt.NDArray[np.float64],
     Y: npt.NDArray[np.float64],
-    speed: npt.NDArray[np.float64],
+    values: Optional[npt.NDArray[np.float64]],
+    func: str,
+    bins: Optional["GridBins"] = None,
 ) -> npt.NDArray[np.float64]:
-    """Calculate speed average over time"""
+    """Statistic of values in the cells of the grid (y x x), 0 if empty
+
+    With bins (the GridBins of X, Y on this grid) only the reduction is
+    computed, otherwise the points are binned with binned_statistic_2d.
+    """
+
+    if bins is not None:
+        return np.array(np.nan_to_num(bins.statistic(values, func)))
 
     xbins = np.arange(geominX, geomaxX + dx, dx)
     ybins = np.arange(geominY, geomaxY + dy, dy)
     ret = stats.binned_statistic_2d(
         X,
         Y,
-        speed,
-        "mean",
+        values,
+        func,
         bins=[xbins, ybins],
     )
-
     return np.array(np.nan_to_num(ret.statistic.T))
 
 
+def calculate_speed_average(
+    geominX: float,
+    geomaxX: float,
+    geominY: float,
+    geomaxY: float,
+    dx: float,
+    dy: float,
+    X: npt.NDArray[np.float64],
+    Y: npt.NDArray[np.float64],
+    speed: npt.NDArray[np.float64],
+    bins: Optional["GridBins"] = None,
+) -> npt.NDArray[np.float64]:
+    """Calculate speed average over time"""
+
+    return binned_statistic(
+        geominX, geomaxX, geominY, geomaxY, dx, dy, X, Y, speed, "mean", bins
+    )
+
+
 def calculate_density_average_weidmann(
     geominX: float,
     geomaxX: float,
@@ -791,19 +1040,13 @@ def calculate_density_average_weidmann(
     X: npt.NDArray[np.float64],
     Y: npt.NDArray[np.float64],
     speed: npt.NDArray[np.float64],
+    bins: Optional["GridBins"] = None,
 ) -> npt.NDArray[np.float64]:
     """Calculate density using Weidmann(speed)"""
     density = inv_weidmann(speed)
-    xbins = np.arange(geominX, geomaxX + dx, dx)
-    ybins = np.arange(geominY, geomaxY + dy, dy)
-    ret = stats.binned_statistic_2d(
-        X,
-        Y,
-        density,
-        "mean",
-        bins=[xbins, ybins],
-    )
-    return np.array(np.nan_to_num(ret.statistic.T))  # / nframes
+    return binned_statistic(
+        geominX, geomaxX, geominY, geomaxY, dx, dy, X, Y, density, "mean", bins
+    )  # / nframes
 
 
 def calculate_density_average_classic(
@@ -816,23 +1059,18 @@ def calculate_density_average_classic(
     nframes: int,
     X: npt.NDArray[np.float64],
     Y: npt.NDArray[np.float64],
+    bins: Optional["GridBins"] = None,
 ) -> npt.NDArray[np.float64]:
     """Calculate classical method
 
     Density = mean_time(N/A_i)
     """
 
-    xbins = np.arange(geominX, geomaxX + dx, dx)
-    ybins = np.arange(geominY, geomaxY + dy, dy)
     area = dx * dy
-    ret = stats.binned_statistic_2d(
-        X,
-        Y,
-        None,
-        "count",
-        bins=[xbins, ybins],
+    counts = binned_statistic(
+        geominX, geomaxX, geominY, geomaxY, dx, dy, X, Y, None, "count", bins
     )
-    return np.array(np.nan_to_num(ret.statistic.T)) / nframes / area
+    return counts / nframes / area
 
 
 def calculate_density_frame_classic(
@@ -850,17 +1088,11 @@ def calculate_density_frame_classic(
     Density = mean_time(N/A_i)
     """
 
-    xbins = np.arange(geominX, geomaxX + dx, dx)
-    ybins = np.arange(geominY, geomaxY + dy, dy)
     area = dx * dy
-    ret = stats.binned_statistic_2d(
-        X,
-        Y,
-        None,
-        "count",
-        bins=[xbins, ybins],
+    counts = binned_statistic(
+        geominX, geomaxX, geominY, geomaxY, dx, dy, X, Y, None, "count"
     )
-    return np.array(np.nan_to_num(ret.statistic.T)) / area
+    return counts / area
 
 
 def calculate_RSET(
@@ -874,18 +1106,140 @@ def calculate_RSET(
     Y: npt.NDArray[np.float64],
     time: npt.NDArray[np.float64],
     func: str,
+    bins: Optional["GridBins"] = None,
 ) -> npt.NDArray[np.float64]:
     """Calculate RSET according to 5.5.1 RSET Maps in Schroder2017a"""
-    xbins = np.arange(geominX, geomaxX + dx, dx)
-    ybins = np.arange(geominY, geomaxY + dy, dy)
-    ret = stats.binned_statistic_2d(
-        X,
-        Y,
-        time,
-        func,
-        bins=[xbins, ybins],
+    return binned_statistic(
+        geominX, geomaxX, geominY, geomaxY, dx, dy, X, Y, time, func, bins
     )
-    return np.array(np.nan_to_num(ret.statistic.T))
+
+
+def area_time_series(
+    positions: npt.NDArray[np.int64],
+    num_frames: int,
+    inside: List[npt.NDArray[np.int64]],
+    areas: List[float],
+    speed: npt.NDArray[np.float64],
+) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]:
+    """Classical density and mean speed in measurement areas for all frames
+
+    One bincount over the combined index (area, frame) of the rows
+    inside each area.
+
+    :param positions: frame index of each row (see FrameIndex.positions)
+    :param inside: indices of the rows inside each area
+    :param areas: size of each area
+    :returns: density and mean speed (areas x frames, 0 if empty)
+    """
+
+    index = np.concatenate(
+        [k * num_frames + positions[rows] for k, rows in enumerate(inside)]
+    )
+    rows = np.concatenate(inside)
+    size = len(inside) * num_frames
+    counts = np.bincount(index, minlength=size).reshape(len(inside), num_frames)
+    sums = np.bincount(index, speed[rows], minlength=size).reshape(counts.shape)
+    density = counts / np.asarray(areas, dtype=np.float64)[:, np.newaxis]
+    mean_speed = np.divide(sums, counts, out=np.zeros(counts.shape), where=counts > 0)
+    return density, mean_speed
+
+
+def gauss_time_series(
+    positions: npt.NDArray[np.int64],
+    num_frames: int,
+    X: npt.NDArray[np.float64],
+    Y: npt.NDArray[np.float64],
+    x0: float,
+    y0: float,
+    width: float,
+) -> npt.NDArray[np.float64]:
+    """Gaussian density at (x0, y0) for all frames
+
+    Same as calculate_density_average_gauss(...)[0, 0] with the rows of
+    each frame.
+    """
+
+    a = width_gaussian(width)
+    weights = Gauss(X - x0, a) * Gauss(Y - y0, a)
+    return np.bincount(positions, weights, minlength=num_frames)
+
+
+def density_speed_cube(
+    bins: "GridBins",
+    frame: npt.NDArray[np.float64],
+    speed: npt.NDArray[np.float64],
+    frames: npt.NDArray[np.float64],
+    window: int,
+    area: float,
+) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float32], npt.NDArray[np.float32]]:
+    """Classical density and mean speed in each time window and cell
+
+    The rows are counted with one bincount over the combined index
+    (window, cell); the density is averaged over the frames of the window.
+    Density and speed are divided directly into the float32 results, so
+    the peak memory is about 24 bytes per window and cell: the two
+    bincounts and the two results.
+    See cube_windows for the size of the results.
+
+    :param bins: GridBins of the rows
+    :param frame: frame of each row
+    :param speed: speed of each row
+    :param frames: all frames (unique, sorted)
+    :param window: frames per time window
+    :param area: area of a cell in m^2
+    :returns: first frame of each window, density and speed
+              (windows x y x x, float32, speed is NaN in empty cells)
+    """
+
+    first = frames[0]
+    num_windows = cube_windows(frames, window)
+    num_cells = bins.num_cells + 1  # with the cell of the points outside
+    index = ((frame - first) // window).astype(np.int64) * num_cells + bins.cell
+    shape = (num_windows, num_cells)
+    counts = np.bincount(index, minlength=num_windows * num_cells).reshape(shape)
+    counts = counts[:, :-1]
+    frames_per_window = np.bincount(
+        ((frames - first) // window).astype(np.int64), minlength=num_windows
+    )
+    cube_shape = (num_windows,) + bins.shape
+    density = np.empty(cube_shape, dtype=np.float32)
+    np.divide(
+        counts,
+        (frames_per_window * area)[:, np.newaxis],
+        out=density.reshape(counts.shape),
+    )
+    sums = np.bincount(index, speed, minlength=num_windows * num_cells).reshape(shape)
+    del index
+    mean_speed = np.full(cube_shape, np.nan, dtype=np.float32)
+    np.divide(
+        sums[:, :-1], counts, out=mean_speed.reshape(counts.shape), where=counts > 0
+    )
+    return first + window * np.arange(num_windows), density, mean_speed
+
+
+def cube_windows(frames: npt.NDArray[np.float64], window: int) -> int:
+    """Number of time windows of density_speed_cube"""
+
+    return int((frames[-1] - frames[0]) // window) + 1
+
+
+def cube_window_for_size(
+    frames: npt.NDArray[np.float64], window: int, num_cells: int, max_bytes: int
+) -> Optional[int]:
+    """Smallest window >= window whose density_speed_cube has at most max_bytes
+
+    Density and speed take 8 bytes per window and cell, the first frames
+    8 bytes per window. Returns None if even a single window is too large.
+    """
+
+    max_windows = max_bytes // (8 * num_cells + 8)
+    if max_windows < 1:
+        return None
+
+    if cube_windows(frames, window) <= max_windows:
+        return window
+
+    return int((frames[-1] - frames[0]) // max_windows) + 1
 
 
 def check_shape_and_stop(shape: int, how_speed: str):
@@ -901,6 +1255,12 @@ def check_shape_and_stop(shape: int, how_speed: str):
         st.stop()
 
 
+# calculate_density_average_gauss sums exactly up to this many matrix entries
+MAX_GAUSS_MATRIX_SIZE = 1 << 22
+# cells per axis of the grid of binned_density_field
+MAX_GAUSS_GRID_CELLS = 4096
+
+
 def width_gaussian(fwhm: float) -> float:
     """np.sqrt(2) / (2 * np.sqrt(2 * np.log(2)))"""
 
@@ -934,6 +1294,70 @@ def xdens_ydens(
     return x_dens, y_dens
 
 
+def binned_density_field(
+    lattice_x: npt.NDArray[np.float64],
+    lattice_y: npt.NDArray[np.float64],
+    x_array: npt.NDArray[np.float64],
+    y_array: npt.NDArray[np.float64],
+    a: float,
+    chunk_rows: int = 1 << 20,
+    stats: Optional[Dict[str, float]] = None,
+) -> npt.NDArray[np.float64]:
+    """density_field from a histogram of the points on a fine grid
+
+    The points are deposited linearly (cloud in cell) on a grid of spacing
+    about a / 10, then the histogram is convolved with the separable
+    Gaussian at the lattice points: Gy @ H.T @ Gx.T.
+    Memory is proportional to the grid size; the points are processed in
+    chunks of chunk_rows. Points farther than 6 a from the lattice are
+    ignored (their weight is below 1e-15).
+    The relative error is about (h / a)^2 / 6 for the spacing h, 0.2% for
+    a / 10. If the grid would exceed MAX_GAUSS_GRID_CELLS per axis, h is
+    increased and a warning with the expected error is logged.
+
+    :param stats: if given, filled with the spacing and the expected error
+    """
+
+    cut = 6 * a
+    extent = max(np.ptp(lattice_x), np.ptp(lattice_y)) + 2 * cut
+    h = max(a / 10, extent / MAX_GAUSS_GRID_CELLS)
+    error = (h / a) ** 2 / 6
+    if h > a / 10:
+        logging.warning(
+            f"Binned Gaussian density: grid limited to {MAX_GAUSS_GRID_CELLS} "
+            f"cells, spacing {h / a:.2f} a, expected error {error:.1%}"
+        )
+
+    if stats is not None:
+        stats["spacing / a"] = h / a
+        stats["expected error"] = error
+
+    x0 = lattice_x[0] - cut
+    y0 = lattice_y[0] - cut
+    nx = int(np.ceil((lattice_x[-1] + cut - x0) / h)) + 2
+    ny = int(np.ceil((lattice_y[-1] + cut - y0) / h)) + 2
+    hist = np.zeros(nx * ny)
+    for start in range(0, len(x_array), chunk_rows):
+        u = (x_array[start : start + chunk_rows] - x0) / h
+        v = (y_array[start : start + chunk_rows] - y0) / h
+        inside = (u >= 0) & (u < nx - 1) & (v >= 0) & (v < ny - 1)
+        u = u[inside]
+        v = v[inside]
+        i = u.astype(np.int64)
+        j = v.astype(np.int64)
+        wx = u - i
+        wy = v - j
+        cell = i * ny + j
+        hist += np.bincount(cell, (1 - wx) * (1 - wy), minlength=nx * ny)
+        hist += np.bincount(cell + 1, (1 - wx) * wy, minlength=nx * ny)
+        hist += np.bincount(cell + ny, wx * (1 - wy), minlength=nx * ny)
+        hist += np.bincount(cell + ny + 1, wx * wy, minlength=nx * ny)
+
+    gauss_x = Gauss(np.subtract.outer(lattice_x, x0 + h * np.arange(nx)), a)
+    gauss_y = Gauss(np.subtract.outer(lattice_y, y0 + h * np.arange(ny)), a)
+    return np.array(gauss_y @ hist.reshape(nx, ny).T @ gauss_x.T)
+
+
 def calculate_density_average_gauss(
     geominX: float,
     geomaxX: float,
@@ -945,15 +1369,29 @@ def calculate_density_average_gauss(
     width: float,
     X: npt.NDArray[np.float64],
     Y: npt.NDArray[np.float64],
+    binned: Optional[bool] = None,
 ):
     """
     Calculate density using Gauss method
+
+    :param binned: use binned_density_field instead of the exact sum over
+                   all rows. Default: only for many rows and lattice points
     """
 
     xbins = np.arange(geominX, geomaxX + dx, dx)
     ybins = np.arange(geominY, geomaxY + dy, dy)
-    x_dens, y_dens = xdens_ydens(X, Y, xbins, ybins)
     a = width_gaussian(width)
+    if binned is None:
+        # the exact sum needs two (rows x lattice) matrices
+        binned = len(X) * (len(xbins) + len(ybins)) > MAX_GAUSS_MATRIX_SIZE
+
+    if binned:
+        with profile("Binned Gaussian density") as stats:
+            density = binned_density_field(xbins, ybins, X, Y, a, stats=stats)
+
+        return density / nframes
+
+    x_dens, y_dens = xdens_ydens(X, Y, xbins, ybins)
     rho_matrix = density_field(x_dens, y_dens, a) / nframes
     return rho_matrix
 
@@ -1012,6 +1450,7 @@ def consecutive_chunks(
 
 def jam_waiting_time(
     data: npt.NDArray[np.float64],
+    agents: "AgentIndex",
     jam_speed: float,
     jam_min_duration: int,
     fps: int,
@@ -1022,9 +1461,8 @@ def jam_waiting_time(
     return a 2D array [ped, waiting_time]
     """
     waiting_times = []
-    peds = np.unique(data[:, 0]).astype(int)
-    for ped in peds:
-        data_ped = data[data[:, 0] == ped]
+    for ped, rows in agents:
+        data_ped = data[rows]
         frames_in_jam = jam_frames(data_ped, jam_speed)
         jam_times, _ = consecutive_chunks(frames_in_jam, precision)
 
@@ -1039,7 +1477,7 @@ def jam_waiting_time(
 
 
 def jam_lifetime(
-    data: npt.NDArray[np.float64],
+    frame_index: "FrameIndex",
     jam_frames,
     jam_min_agents: int,
     fps: int,
@@ -1049,24 +1487,18 @@ def jam_lifetime(
 ]:
     """Lifespane of a Jam and how many pedestrian in chunck"""
 
-    lifetime = []
-    all_frames = np.unique(data[:, 1]).astype(int)
     # frame, num peds in jam. Using only the first,
     # since I dont know yet how to use the second
     # Ignore the first frames, where agents start from 0 (so in jam)
-    for frame in all_frames:
-        if frame in jam_frames:
-            d = data[data[:, 1] == frame]
-            num_ped_in_jam = len(d[:, 0])
-            if num_ped_in_jam >= jam_min_agents:
-                lifetime.append([frame, num_ped_in_jam])
-
-    lifetime_arr = np.array(lifetime)
+    all_frames = frame_index.frames.astype(int)
+    num_peds = frame_index.counts()
+    mask = np.isin(all_frames, jam_frames) & (num_peds >= jam_min_agents)
+    lifetime_arr = np.column_stack((all_frames[mask], num_peds[mask]))
 
     if not lifetime_arr.size:
         return np.array([]), np.array([]), 0, np.array([])
 
-    chuncks, ret = consecutive_chunks(np.array(lifetime)[:, 0], precision)
+    chuncks, ret = consecutive_chunks(lifetime_arr[:, 0], precision)
     # print("clifetime ", clifetime)
     if not chuncks.size:  # one big chunk
         chuncks = lifetime_arr[:, 0]
@@ -1081,10 +1513,22 @@ def calculate_NT_data(
     transitions: dict,
     selected_transitions: dict,
     data: npt.NDArray[np.float64],
+    agents: "AgentIndex",
     fps: int,
+    grid: Optional["SegmentGrid"] = None,
+    events_cache=None,
+    dataset: Hashable = None,
+    workers: int = 1,
 ) -> Tuple[dict, dict, dict, dict, dict, int, str]:
     """Frame and cumulative number of pedestrian passing transitions.
 
+    If events_cache (cache.MemoryCache) and dataset (key of the positions
+    in data, e.g. trajectory digest and unit) are given,
+    the crossings of each transition are cached and only transitions not
+    seen before are calculated.
+    The crossings are tested near the transitions using the segment grid,
+    with workers > 1 in worker processes (see crossing_events_parallel).
+
     return:
     Frame
     cum_num
@@ -1100,38 +1544,53 @@ def calculate_NT_data(
     msg = ""
     trans_used = {}
 
-    peds = np.unique(data[:, 0]).astype(int)
     with st.spinner("Processing ..."):
         max_len = -1
+        selected = [i for i in transitions if i in selected_transitions]
+        events = {}
+        keys = {i: (dataset, i, transitions[i].tobytes(), fps) for i in selected}
+        if events_cache is not None and dataset is not None:
+            for i in selected:
+                cached = events_cache.get(keys[i])
+                if cached is not None:
+                    events[i] = cached
+
+        missing = [i for i in selected if i not in events]
+        if missing:
+            with profile("Crossing tests") as stats:
+                lines = [transitions[i] for i in missing]
+                if workers > 1:
+                    stats["workers"] = workers
+                    new_events = crossing_events_parallel(
+                        data, agents, lines, workers, grid=grid, dataset=dataset
+                    )
+                else:
+                    new_events = crossing_events(data, agents, lines, grid, stats)
+
+            for k, i in enumerate(missing):
+                events[i] = new_events[new_events[:, 2] == k]
+                if events_cache is not None and dataset is not None:
+                    events_cache.put(keys[i], events[i])
+
+        if events_cache is not None:
+            logging.info(events_cache.stats())
+
         for i, t in transitions.items():
             trans_used[i] = False
             if i in selected_transitions:
-                line = LineString(t)
-                # len_line = line.length
-                for ped in peds:
-                    ped_data = data[data[:, 0] == ped]
-                    # frame = passing_frame(ped_data, line, fps, len_line)
-                    frame, sign = passing_frame(ped_data, line, fps)
-                    if frame >= 0:
-                        tstats[i].append([ped, frame, sign])
-                        trans_used[i] = True
-
+                length = np.linalg.norm(np.diff(t, axis=0), axis=1).sum()
+                # ped, frame, direction. Sorted by time
+                passed = events[i][:, [0, 1, 3]]
+                if len(passed):
+                    tstats[i] = passed
+                    trans_used[i] = True
                 if trans_used[i]:
-                    tstats[i] = np.array(tstats[i])
-                    tstats[i] = tstats[i][tstats[i][:, 1].argsort()]  # sort by frame
                     arrivals = tstats[i][:, 1]
                     arrivals_positiv = arrivals[tstats[i][:, 2] == 1]
                     arrivals_negativ = arrivals[tstats[i][:, 2] == -1]
                     cum_num[i] = np.cumsum(np.ones(len(arrivals)))
-                    inx_pos = np.in1d(arrivals, arrivals_positiv)
-                    inx_neg = np.in1d(arrivals, arrivals_negativ)
-                    tmp_positiv = np.zeros(len(arrivals))
-                    tmp_positiv[inx_pos] = 1
-                    tmp_negativ = np.zeros(len(arrivals))
-                    tmp_negativ[inx_neg] = 1
-
-                    cum_num_positiv[i] = np.cumsum(tmp_positiv)
-                    cum_num_negativ[i] = np.cumsum(tmp_negativ)
+                    cum_num_positiv[i] = np.cumsum(tstats[i][:, 2] == 1).astype(float)
+                    cum_num_negativ[i] = np.cumsum(tstats[i][:, 2] == -1).astype(float)
                     flow = (cum_num[i][-1] - 1) / (arrivals[-1] - arrivals[0]) * fps
                     if arrivals_positiv.size:
                         flow_positiv = (
@@ -1156,32 +1615,49 @@ def calculate_NT_data(
                     max_len = max(
                         max_len, cum_num_positiv[i].size, cum_num_negativ[i].size
                     )
-                    msg += f"Transition {i}: length {line.length:.2f}, flow+: {flow_positiv:.2f}, flow-: {flow_negativ:.2f} flow: {flow:.2f} [1/s],  specific flow: {flow/line.length:.2f} [1/s/m] \n \n"
+                    msg += f"Transition {i}: length {length:.2f}, flow+: {flow_positiv:.2f}, flow-: {flow_negativ:.2f} flow: {flow:.2f} [1/s],  specific flow: {flow/length:.2f} [1/s/m] \n \n"
                 else:
-                    msg += (
-                        f"Transition {i}: length {line.length:.2f}, flow: 0 [1/s] \n \n"
-                    )
+                    msg += f"Transition {i}: length {length:.2f}, flow: 0 [1/s] \n \n"
 
     return tstats, cum_num, cum_num_positiv, cum_num_negativ, trans_used, max_len, msg
 
 
 #
-def CDF(x: float, times: npt.NDArray[np.float64]) -> float:
-    """empirical CDF P(x<=X)"""
+def CDF(
+    x: Union[float, npt.NDArray[np.float64]], times: npt.NDArray[np.float64]
+) -> Union[float, npt.NDArray[np.float64]]:
+    """empirical CDF P(x<=X), x can be an array"""
 
-    return float(len(times[times <= x])) / len(times)
+    cdf = np.searchsorted(np.sort(times), x, side="right") / len(times)
+    return float(cdf) if np.ndim(cdf) == 0 else cdf
 
 
 def survival(
     times: npt.NDArray[np.float64],
+    unique: bool = False,
+    log_bins: int = 0,
 ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]:
-    """survival function"""
+    """survival function of the time gaps between times
+
+    :param unique: one point per distinct gap instead of one per gap (ties)
+    :param log_bins: if > 0, evaluate at log_bins log-spaced positive gaps
+    :returns: P(gap > Delta), Delta
+    """
+
+    diff = np.sort(np.diff(times))
+    if log_bins > 0:
+        positive = diff[diff > 0]
+        if not positive.size:
+            return np.array([]), np.array([])
 
-    diff = np.diff(times)
-    diff = np.sort(diff)
-    vF = np.vectorize(CDF, excluded=["times"])
-    y_diff = 1 - vF(x=diff, times=diff)
-    return y_diff, diff
+        diff_x = np.geomspace(positive[0], positive[-1], log_bins)
+    elif unique:
+        diff_x = np.unique(diff)
+    else:
+        diff_x = diff
+
+    y_diff = 1 - np.searchsorted(diff, diff_x, side="right") / len(diff)
+    return y_diff, diff_x
 
 
 def rolling_flow(
@@ -1208,23 +1684,158 @@ def rolling_flow(
     return np.mean(wmean), np.mean(wstd)
 
 
-def peds_inside(data: npt.NDArray[np.float64]) -> List:
-    """TODO describe function"""
+def flow_series(
+    tstats: dict,
+    fps: int,
+    windows: List[float],
+    first_frame: int,
+    last_frame: int,
+) -> Tuple[npt.NDArray[np.float64], dict, dict, dict]:
+    """Flow J(t) of each transition in sliding windows
+
+    J(t) is the number of crossings in the window (t - w, t] divided by w.
+    All transitions and windows are computed at once from prefix sums of
+    one frame histogram of the crossings.
+
+    :param tstats: ped, frame, direction of the crossings of each transition
+    :param windows: window sizes in seconds
+    :returns: times, J (windows x times, NaN until the first window is
+              complete), mean and std of J for each transition and window
+    """
+
+    used = [i for i, passed in tstats.items() if len(passed)]
+    num_frames = int(last_frame - first_frame) + 1
+    times = np.arange(num_frames) / fps + first_frame / fps
+    if not used or not windows or num_frames < 1:
+        return times, {}, {}, {}
+
+    frames = [tstats[i][:, 1] - first_frame for i in used]
+    trans = np.repeat(np.arange(len(used)), [len(f) for f in frames])
+    frames = np.clip(np.concatenate(frames).astype(np.int64), 0, num_frames - 1)
+    hist = np.bincount(
+        trans * num_frames + frames, minlength=len(used) * num_frames
+    ).reshape(len(used), num_frames)
+    # prefix[k, t] = crossings of transition k before frame t
+    prefix = np.zeros((len(used), num_frames + 1))
+    np.cumsum(hist, axis=1, out=prefix[:, 1:])
+
+    width = np.maximum(np.rint(np.asarray(windows) * fps).astype(np.int64), 1)
+    end = np.arange(1, num_frames + 1)
+    start = end[np.newaxis, :] - width[:, np.newaxis]
+    counts = prefix[:, np.newaxis, end] - prefix[:, np.maximum(start, 0)]
+    J = counts * (fps / width)[np.newaxis, :, np.newaxis]
+    J[:, start < 0] = np.nan
+    complete = (start >= 0).any(axis=1)
+    J_mean = np.full((len(used), len(width)), np.nan)
+    J_std = np.full((len(used), len(width)), np.nan)
+    J_mean[:, complete] = np.nanmean(J[:, complete], axis=2)
+    J_std[:, complete] = np.nanstd(J[:, complete], axis=2)
+    return (
+        times,
+        dict(zip(used, J)),
+        dict(zip(used, J_mean)),
+        dict(zip(used, J_std)),
+    )
+
+
+STATS_COLUMNS = ["line", "pid", "frame", "direction", "count_tot", "count+", "count-"]
+
+
+def crossings_table(tstats: dict, lines: List[int]) -> npt.NDArray[np.float64]:
+    """Crossings of lines as one table with columns STATS_COLUMNS
+
+    The counts are the cumulative number of crossings of the line
+    (total, in positive and in negative direction) up to each crossing.
+    """
+
+    table = np.empty((sum(len(tstats[i]) for i in lines), len(STATS_COLUMNS)))
+    start = 0
+    for i in lines:
+        passed = tstats[i]
+        rows = slice(start, start + len(passed))
+        table[rows, 0] = i
+        table[rows, 1:4] = passed
+        table[rows, 4] = np.arange(1, len(passed) + 1)
+        np.cumsum(passed[:, 2] == 1, out=table[rows, 5])
+        np.cumsum(passed[:, 2] == -1, out=table[rows, 6])
+        start += len(passed)
+
+    return table
+
+
+def export_stats(
+    tstats: dict,
+    lines: List[int],
+    fps: int,
+    fmt: str = "csv",
+    flow: Optional[tuple] = None,
+) -> io.BytesIO:
+    """Crossings of lines (and flow series) as in-memory csv or npz file
+
+    :param flow: times, J, J_mean, J_std, windows (see flow_series)
+    :param fmt: csv: table of the crossings, then a second table
+                with time and the flow of each line and window;
+                npz: the tables and the flow statistics as arrays
+    """
+
+    table = crossings_table(tstats, lines)
+    flow_columns = ["time"]
+    flows = np.empty((0, 1))
+    summary = ""
+    if flow is not None:
+        times, J, J_mean, J_std, windows = flow
+        flow_columns += [f"J{i}_{w}s" for i in J for w in windows]
+        flows = np.vstack([times] + [J[i] for i in J]).T
+        for i in J:
+            for k, w in enumerate(windows):
+                summary += (
+                    f"\nflow line {i}, window {w} s: "
+                    f"{J_mean[i][k]:.4f} +- {J_std[i][k]:.4f}"
+                )
+
+    buffer = io.BytesIO()
+    if fmt == "npz":
+        np.savez_compressed(
+            buffer,
+            crossings=table,
+            columns=np.array(STATS_COLUMNS),
+            flow=flows,
+            flow_columns=np.array(flow_columns),
+            fps=fps,
+        )
+    else:
+        np.savetxt(
+            buffer,
+            table,
+            fmt="%d",
+            delimiter=",",
+            header=f"framerate: {fps:.0f}{summary}\n" + ",".join(STATS_COLUMNS),
+        )
+        if flow is not None:
+            # NaN: window not yet complete
+            np.savetxt(
+                buffer,
+                flows,
+                fmt=["%.2f"] + (flows.shape[1] - 1) * ["%.4f"],
+                delimiter=",",
+                header="\n" + ",".join(flow_columns),
+            )
+
+    buffer.seek(0)
+    return buffer
+
 
-    p_inside = []
-    frames = np.unique(data[:, 1])
-    for frame in frames:
-        d = data[data[:, 1] == frame][:, 0]
-        p_inside.append(len(d))
+def peds_inside(frame_index: "FrameIndex") -> List:
+    """Number of pedestrians in each frame"""
 
-    return p_inside
+    return list(frame_index.counts())
 
 
 def get_neighbors_at_frame(
-    frame: int, data: npt.NDArray[np.float64], k: int
+    frame: int, data: npt.NDArray[np.float64], frame_index: "FrameIndex", k: int
 ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]:
     """TODO describe function"""
-    at_frame = data[data[:, 1] == frame]
+    at_frame = frame_index.rows(data, frame)
     points = at_frame[:, 2:4]
     tree = KDTree(points)
     if k < len(points):
@@ -1238,6 +1849,7 @@ def get_neighbors_special_agent_data(
     agent: int,
     frame: int,
     data: npt.NDArray[np.float64],
+    frame_index: "FrameIndex",
     nearest_dist: npt.NDArray[np.float64],
     nearest_ind: npt.NDArray[np.float64],
 ) -> Tuple[
@@ -1247,7 +1859,7 @@ def get_neighbors_special_agent_data(
     npt.NDArray[np.float64],
     npt.NDArray[np.float64],
 ]:
-    at_frame = data[data[:, 1] == frame]
+    at_frame = frame_index.rows(data, frame)
     points = at_frame[:, 2:4]
     _speeds = at_frame[:, st.session_state.speed_index]
     Ids = at_frame[:, 0]
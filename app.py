@@ -2,11 +2,12 @@ import datetime as dt
 import os
 import timeit
 from collections import defaultdict
-from copy import deepcopy
 from pathlib import Path
+from typing import Tuple
 
 import lovely_logger as logging  # type: ignore
 import numpy as np  # type: ignore
+import numpy.typing as npt  # type: ignore
 import streamlit as st  # type: ignore
 from hydralit import HydraApp  # type: ignore
 from apps import (
@@ -24,6 +25,7 @@ from apps import (
 
 import doc
 import Utilities
+import cache
 import data_structure
 
 path = Path(__file__)
@@ -60,8 +62,8 @@ def set_state_variables():
     if "img_width" not in st.session_state:
         st.session_state.img_width = 100
 
-    if "old_data" not in st.session_state:
-        st.session_state.old_data = ""
+    if "traj_digest" not in st.session_state:
+        st.session_state.traj_digest = ""
 
     if "data" not in st.session_state:
         st.session_state.data = np.array([])
@@ -69,26 +71,11 @@ def set_state_variables():
     if "orig_data" not in st.session_state:
         st.session_state.orig_data = np.array([])
 
-    if "geometry_data" not in st.session_state:
-        st.session_state.geometry_data = ""
+    if "geo_digest" not in st.session_state:
+        st.session_state.geo_digest = ""
 
-    if "geominX" not in st.session_state:
-        st.session_state.geominX = -10
-
-    if "geomaxX" not in st.session_state:
-        st.session_state.geomaxX = 10
-
-    if "geominY" not in st.session_state:
-        st.session_state.geominY = -10
-
-    if "geomaxY" not in st.session_state:
-        st.session_state.geomaxY = 10
-
-    if "geometry_wall" not in st.session_state:
-        st.session_state.geometry_wall = 10
-
-    if "transitions" not in st.session_state:
-        st.session_state.transitions = []
+    if "geometry" not in st.session_state:
+        st.session_state.geometry = None
 
     if "fps" not in st.session_state:
         st.session_state.fps = 16
@@ -111,8 +98,23 @@ def set_state_variables():
     if "unit" not in st.session_state:
         st.session_state.unit = "m"
 
-    if "df" not in st.session_state:
-        st.session_state.df = 12
+    if "data_key" not in st.session_state:
+        st.session_state.data_key = None
+
+    if "data_df" not in st.session_state:
+        st.session_state.data_df = None
+
+    if "segment_grid" not in st.session_state:
+        st.session_state.segment_grid = None
+
+    if "agents" not in st.session_state:
+        st.session_state.agents = None
+
+    if "frame_index" not in st.session_state:
+        st.session_state.frame_index = None
+
+    if "columns" not in st.session_state:
+        st.session_state.columns = []
 
     if "xpos" not in st.session_state:
         st.session_state.xpos = None
@@ -127,6 +129,38 @@ def set_state_variables():
         st.session_state.example_downloaded = {}
 
 
+def normalize_data(
+    digest, orig_data, agents, columns, how_speed, fps, df, unit
+) -> Tuple[
+    npt.NDArray[np.float64], data_structure.LazyDataFrame, data_structure.SegmentGrid
+]:
+    """Return trajectories in m with speed and angle, DataFrame and segment grid
+
+    Done once per dataset, unit and df. The result is read-only and shared
+    by all reruns and tabs.
+    """
+
+    speed_index = st.session_state.speed_index
+    data = orig_data
+    if how_speed == "from experiment" or speed_index == -1:
+        data = cache.speed_and_angle(digest, orig_data, agents, fps, df)
+
+    if unit == "cm":
+        if data is orig_data:
+            data = np.array(orig_data)
+
+        data[:, 2:4] /= 100
+        data[:, speed_index] /= 100
+
+    data.flags.writeable = False
+    with Utilities.profile("Build segment grid") as stats:
+        grid = data_structure.SegmentGrid.from_sorted(data, agents)
+        stats["cells"] = grid.shape[0] * grid.shape[1]
+        stats["entries per segment"] = len(grid.segments) / max(grid.num_segments, 1)
+
+    return data, data_structure.LazyDataFrame(data, columns), grid
+
+
 def main():
     time_start = timeit.default_timer()
 
@@ -160,25 +194,33 @@ def main():
         type=["xml"],
         help="Load geometry file",
     )
+    compact = st.sidebar.checkbox(
+        "Compact mode",
+        help="Store trajectories in single precision (float32) to halve the memory. Coordinates are rounded to about 7 digits",
+    )
     st.sidebar.markdown("-------")
     unit_pl = st.sidebar.empty()
 
     msg_status = st.sidebar.empty()
     disable_NT_flow = False
-    files = data_structure.data_files(trajectory_file, geometry_file, from_examples)
+    files = data_structure.data_files(
+        trajectory_file, geometry_file, from_examples, compact
+    )
     if files.got_traj_data:
         try:
-            string_data = files.process_traj_file()
-            if string_data != st.session_state.old_data:
-                st.session_state.old_data = string_data
+            header = files.header
+            # reload if the precision changes
+            traj_digest = f"{files.traj_digest}-{'float32' if compact else 'float64'}"
+            if traj_digest != st.session_state.traj_digest:
+                st.session_state.traj_digest = traj_digest
                 new_data = True
                 logging.info("Loading new trajectory data")
             else:
                 logging.info("Trajectory data existing")
                 new_data = False
 
-            group_index = Utilities.get_index_group(string_data)
-            if Utilities.detect_jpscore(string_data):
+            group_index = header.group_index
+            if header.source == "jpscore":
                 how_speed = "from simulation"
                 st.write(
                     "<style>div.row-widget.stRadio > div{flex-direction:row;}</style>",
@@ -191,38 +233,27 @@ def main():
 
             if new_data:
                 with Utilities.profile("Load trajectories"):
-                    data = files.get_data()
-                    
-                    st.session_state.orig_data = np.copy(data)
-                    fps = Utilities.get_fps(string_data)
-                    speed_index = Utilities.get_speed_index(string_data)
-                    header_traj = Utilities.get_header(string_data)
-                    logging.info(f"Speed index: {speed_index}")
-                    if speed_index == -1:  # data.shape[1] < 10:  # extend data
-                        data = Utilities.compute_speed_and_angle(
-                            data, fps, st.session_state.df
-                        )
-
-                    unit = Utilities.get_unit(string_data)
-                    st.session_state.unit = unit
-                    st.session_state.data = np.copy(data)
-                    st.session_state.fps = fps
-                    st.session_state.speed_index = speed_index
-                    st.session_state.header_traj = header_traj
+                    files.read_traj_data()
+                    if files.from_cache:
+                        logging.info(f"Trajectory cache hit: {files.traj_digest}")
+
+                    # read-only, may be memory-mapped from the cache
+                    st.session_state.orig_data = files.get_data()
+                    st.session_state.agents = files.get_agents()
+                    st.session_state.frame_index = files.get_frame_index()
+                    st.session_state.columns = files.get_columns()
+                    logging.info(f"Speed index: {header.speed_index}")
+                    st.session_state.unit = header.unit
+                    st.session_state.fps = header.fps
+                    st.session_state.speed_index = header.speed_index
+                    st.session_state.header_traj = header.header
+                    st.session_state.data_key = None
                     st.session_state.bg_img = None
                     logging.info("Done loading trajectories")
 
-            else:
-                with Utilities.profile("Second init"):
-                    data = np.copy(st.session_state.data)
-                    fps = st.session_state.fps
-                    unit = st.session_state.unit
-                    speed_index = st.session_state.speed_index
-                    header_traj = st.session_state.header_traj
-                    logging.info(
-                        f"Second init of trajectories {st.session_state.data.shape}"
-                    )
-
+            fps = st.session_state.fps
+            unit = st.session_state.unit
+            header_traj = st.session_state.header_traj
             if unit not in ["cm", "m"]:
                 unit = unit_pl.radio(
                     "What is the unit of the trajectories?",
@@ -245,49 +276,25 @@ def main():
             st.stop()
 
         try:
-            geo_string_data = files.process_geo_file()
-            if geo_string_data != st.session_state.geometry_data:
+            geo_digest = files.geo_fingerprint()
+            if geo_digest != st.session_state.geo_digest:
                 with Utilities.profile("Load geometry:"):
                     # new_geometry = True
-                    st.session_state.geometry_data = geo_string_data
-                    geo_xml = files.read_geo_data()
-
+                    st.session_state.geo_digest = geo_digest
+                    geometry = files.read_geometry()
                     logging.info("Geometry parsed successfully")
-                    geometry_wall = Utilities.read_subroom_walls(geo_xml, unit="m")
-                    logging.info("Got geometry walls successfully")
-                    transitions = Utilities.get_transitions(geo_xml, unit="m")
-                    logging.info("Got geometry transitions successfully")
-                    measurement_lines = Utilities.get_measurement_lines(
-                        geo_xml, unit="m"
-                    )
-                    logging.info("Got geometry measurement_lines successfully")
-                    # todo: check if ids of transitions and measurement_lines are unique
-                    transitions.update(measurement_lines)
-                    logging.info("Get geo_limits")
-                    geominX, geomaxX, geominY, geomaxY = Utilities.geo_limits(
-                        geo_xml, unit="m"
-                    )
-                    st.session_state.geominX = geominX
-                    st.session_state.geomaxX = geomaxX
-                    st.session_state.geominY = geominY
-                    st.session_state.geomaxY = geomaxY
-                    st.session_state.transitions = deepcopy(transitions)
-                    st.session_state.geometry_wall = deepcopy(geometry_wall)
+                    st.session_state.geometry = geometry
                     st.session_state.xpos = None
                     st.session_state.ypos = None
                     st.session_state.lm = None
-                    logging.info(
-                        f"GeometrySize: X: ({geominX:.2f},{geomaxX:.2f}), Y: ({geominY:.2f},{geomaxY:.2f})"
-                    )
-            else:
-                with Utilities.profile("Second geome init"):
-                    # new_geometry = False
-                    geominX = st.session_state.geominX
-                    geomaxX = st.session_state.geomaxX
-                    geominY = st.session_state.geominY
-                    geomaxY = st.session_state.geomaxY
-                    geometry_wall = deepcopy(st.session_state.geometry_wall)
-                    transitions = deepcopy(st.session_state.transitions)
+
+            geometry = st.session_state.geometry
+            geominX, geomaxX, geominY, geomaxY = geometry.bounds
+            geometry_wall = geometry.walls
+            transitions = geometry.transitions
+            logging.info(
+                f"GeometrySize: X: ({geominX:.2f},{geomaxX:.2f}), Y: ({geominY:.2f},{geomaxY:.2f})"
+            )
 
             # select all per default
             if transitions:
@@ -304,12 +311,6 @@ def main():
             st.stop()
 
         if unit == "cm":
-            data[:, 2:4] /= 100
-            data[:, st.session_state.speed_index] /= 100
-            # files.get_data_df()[str(Header.X)] /= 100
-            files.get_data_df()["X"] /= 100
-            files.get_data_df()["Y"] /= 100
-            files.get_data_df()["Z"] /= 100
             geominX /= 100
             geomaxX /= 100
             geominY /= 100
@@ -320,33 +321,51 @@ def main():
                 f"CM GeometrySize: X: ({geominX:.2f},{geomaxX:.2f}), Y: ({geominY:.2f},{geomaxY:.2f})"
             )
 
+        agents = st.session_state.agents
+        frame_index = st.session_state.frame_index
+        data_key = (st.session_state.traj_digest, unit, df)
+        if data_key != st.session_state.data_key:
+            with Utilities.profile("Normalize trajectories"):
+                data, data_df, segment_grid = normalize_data(
+                    files.traj_digest,
+                    st.session_state.orig_data,
+                    agents,
+                    st.session_state.columns,
+                    how_speed,
+                    fps,
+                    df,
+                    unit,
+                )
+                st.session_state.data = data
+                st.session_state.data_df = data_df
+                st.session_state.segment_grid = segment_grid
+                st.session_state.data_key = data_key
+
+        data = st.session_state.data
+        data_df = st.session_state.data_df
+        segment_grid = st.session_state.segment_grid
         if how_speed == "from simulation":
             logging.info("speed by simulation")
             Utilities.check_shape_and_stop(data.shape[1], how_speed)
         else:
             logging.info("speed by trajectory")
-            if df != st.session_state.df:
-                data = Utilities.compute_speed_and_angle(
-                    st.session_state.orig_data, fps, df
-                )
-                st.session_state.data = np.copy(data)
-                st.session_state.df = df
-                if unit == "cm":
-                    data[:, 2:4] /= 100
-                    data[:, st.session_state.speed_index] /= 100
 
         pl.empty()
         app.add_loader_app(loader.MyLoadingApp())
         app.add_loader_app(loader.MyLoadingApp())
         app.add_app(
-            "Summary", icon="🔢", app=stats.StatClass(data, unit, fps, header_traj)
+            "Summary",
+            icon="🔢",
+            app=stats.StatClass(data, agents, frame_index, unit, fps, header_traj),
         )
         app.add_app(
             "Trajectories",
             icon="👫🏻",
             app=trajectories.TrajClass(
                 data,
-                files.get_data_df(),
+                agents,
+                frame_index,
+                data_df,
                 how_speed,
                 geometry_wall,
                 transitions,
@@ -357,7 +376,7 @@ def main():
                 fps,
             ),
         )
-        app.add_app("Jam", icon="🐌 ", app=jams.JamClass(data, fps))
+        app.add_app("Jam", icon="🐌 ", app=jams.JamClass(data, agents, frame_index, fps))
         name = files.traj_name
         # if traj_from_upload:
         #     name = trajectory_file.name.split(".txt")[0]
@@ -368,14 +387,31 @@ def main():
             "Statistics",
             icon="📉 ",
             app=time_series.TimeSeriesClass(
-                data, disable_NT_flow, transitions, default, fps, name, group_index
+                data,
+                agents,
+                frame_index,
+                segment_grid,
+                disable_NT_flow,
+                transitions,
+                default,
+                fps,
+                name,
+                group_index,
             ),
         )
         app.add_app(
             "Profiles",
             icon="🟡",
             app=profiles.ProfileClass(
-                data, how_speed, geometry_wall, geominX, geomaxX, geominY, geomaxY, fps
+                data,
+                frame_index,
+                how_speed,
+                geometry_wall,
+                geominX,
+                geomaxX,
+                geominY,
+                geomaxY,
+                fps,
             ),
         )
         app.add_app(
@@ -384,6 +420,8 @@ def main():
             app=dv_time_series.dvTimeSeriesClass(
                 "Time series",
                 data,
+                agents,
+                frame_index,
                 how_speed,
                 geometry_wall,
                 geominX,
@@ -392,6 +430,7 @@ def main():
                 geomaxY,
                 fps,
                 new_data,
+                geometry.areas,
             ),
         )
 
@@ -406,7 +445,14 @@ def main():
             "Neighbors",
             icon="👥",
             app=neighbors.NeighborsClass(
-                data, geominX, geomaxX, geominY, geomaxY, geometry_wall
+                data,
+                agents,
+                frame_index,
+                geominX,
+                geomaxX,
+                geominY,
+                geomaxY,
+                geometry_wall,
             ),
         )
         # Add new tabs here
@@ -2,6 +2,7 @@ import collections
 import logging
 import sys
 
+import data_structure
 import doc
 import draw_geometry as dg
 import matplotlib.pyplot as plt
@@ -21,6 +22,8 @@ class dvTimeSeriesClass(HydraHeadApp):
         self,
         title,
         data,
+        agents,
+        frame_index,
         how_speed,
         geometry_wall,
         geominX,
@@ -29,21 +32,25 @@ class dvTimeSeriesClass(HydraHeadApp):
         geomaxY,
         fps,
         newdata,
+        areas,
     ):
         self.title = title
         self.how_speed = how_speed
         self.fps = fps
         self.data = data
+        self.agents = agents
+        self.frame_index = frame_index
         self.geominX = geominX
         self.geomaxX = geomaxX
         self.geominY = geominY
         self.geomaxY = geomaxY
         self.geometry_wall = geometry_wall
         self.newdata = newdata
+        self.areas = areas
 
     def init_sidebar(self):
         logging.info(f"newdata {self.newdata}")
-        frames = np.unique(self.data[:, 1])
+        frames = self.frame_index.frames
         choose_d_method = st.sidebar.radio(
             "Density method",
             ["Classic", "Gaussian"],
@@ -56,12 +63,11 @@ class dvTimeSeriesClass(HydraHeadApp):
         )
         sample = st.sidebar.slider(
             "Sample rate",
-            min_value=2,
-            max_value=int(np.max(frames * 0.2)),
+            min_value=1,
+            max_value=max(int(np.max(frames * 0.2)), 2),
             value=10,
-            step=5,
-            help="Sample rate of ploting trajectories and time series \
-                (the lower the slower)",
+            step=1,
+            help="Plot every n-th frame of the time series",
             key="sample_traj",
         )
 
@@ -180,7 +186,7 @@ class dvTimeSeriesClass(HydraHeadApp):
         ax.set_ylim((0, height))
         plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
         # inv = ax.transData.inverted()
-        dg.plot_traj(ax, self.data, scale, self.geominX, self.geominY)
+        dg.plot_traj(ax, self.data, self.agents, scale, self.geominX, self.geominY)
         major_ticks_top_x = np.linspace(0, width, 5)
         major_ticks_top_y = np.linspace(0, height, 5)
         minor_ticks_top_x = np.linspace(0, width, 40)
@@ -223,88 +229,68 @@ class dvTimeSeriesClass(HydraHeadApp):
         with info_timeseries:
             doc.doc_timeseries()
 
-        frames = np.unique(self.data[:, 1])
+        frames = self.frame_index.frames
         rects = dvTimeSeriesClass.draw_rects(self, canvas, img_height, dpi, scale)
-        for ir, _ in enumerate(rects):
-            pl = st.empty()
-            c1, c2, c3 = st.columns((1, 1, 1))
-            _, _, c31 = st.columns((1, 1, 1))
-            pl_l = c31.empty()
-            # st.write((rects[ir]['x'][0], rects[ir]['x'][1], rects[ir]['x'][2], rects[ir]['x'][3]))
-            # st.write((rects[ir]['y'][0], rects[ir]['y'][1], rects[ir]['y'][2], rects[ir]['y'][3]))
-            from_x = rects[ir]["x"][0]
-            to_x = rects[ir]["x"][1]
-            from_y = rects[ir]["y"][3]
-            to_y = rects[ir]["y"][0]
-            dx = to_x - from_x
-            dy = to_y - from_y
-            pl.info(f"Measurement area {ir+1}, dx = {dx:.2f} / m, dy = {dy:.2f} / m")
+        areas = {
+            f"{i + 1}": data_structure.MeasurementArea.from_rect(rect["x"], rect["y"])
+            for i, rect in rects.items()
+        }
+        areas.update(
+            (f"area_B {i}", data_structure.MeasurementArea(polygon))
+            for i, polygon in self.areas.items()
+        )
+        if areas:
+            # all frames and areas at once, sample only thins out the plots
+            positions = self.frame_index.positions
+            X = self.data[:, 2]
+            Y = self.data[:, 3]
             if choose_d_method == "Gaussian":
                 with Utilities.profile("time series gauss"):
-                    density_time = []
-                    for frame in frames[::sample]:
-                        dframe = self.data[:, 1] == frame
-                        x = self.data[dframe][:, 2]
-                        y = self.data[dframe][:, 3]
-                        dtime = Utilities.calculate_density_average_gauss(
-                            from_x,
-                            to_x,
-                            from_y,
-                            to_y,
-                            dx,
-                            dy,
-                            1,
-                            gauss_width,
-                            x,
-                            y,
-                        )
-                        density_time.append(dtime[0, 0])
-
-                speed_time = Utilities.weidmann(np.array(density_time))
-
-            if choose_d_method == "Classic":
+                    density_times = np.array(
+                        [
+                            area.cached_gauss_series(
+                                st.session_state.data_key,
+                                positions,
+                                len(frames),
+                                X,
+                                Y,
+                                gauss_width,
+                            )
+                            for area in areas.values()
+                        ]
+                    )
+                    speed_times = Utilities.weidmann(density_times)
+            else:
                 with Utilities.profile("time series classic"):
-                    density_time = []
-                    for frame in frames[::sample]:
-                        dframe = self.data[:, 1] == frame
-                        x = self.data[dframe][:, 2]
-                        y = self.data[dframe][:, 3]
-                        dtime = Utilities.calculate_density_frame_classic(
-                            from_x,
-                            to_x,
-                            from_y,
-                            to_y,
-                            dx,
-                            dy,
-                            x,
-                            y,
-                        )
-                        # st.write(dtime)
-                        density_time.append(dtime[0, 0])
+                    inside = [
+                        area.cached_rows(st.session_state.data_key, X, Y)
+                        for area in areas.values()
+                    ]
+                    density_times, speed_times = Utilities.area_time_series(
+                        positions,
+                        len(frames),
+                        inside,
+                        [area.size for area in areas.values()],
+                        self.data[:, st.session_state.speed_index],
+                    )
 
-                    speed_time = []
-                    for frame in frames[::sample]:
-                        dframe = self.data[:, 1] == frame
-                        x = self.data[dframe][:, 2]
-                        y = self.data[dframe][:, 3]
-                        speed_agent = self.data[dframe][:, st.session_state.speed_index]
-                        stime = Utilities.calculate_speed_average(
-                            from_x,
-                            to_x,
-                            from_y,
-                            to_y,
-                            dx,
-                            dy,
-                            x,
-                            y,
-                            speed_agent,
-                        )
-                        speed_time.append(stime[0, 0])
+        for ir, (name, area) in enumerate(areas.items()):
+            pl = st.empty()
+            c1, c2, c3 = st.columns((1, 1, 1))
+            _, _, c31 = st.columns((1, 1, 1))
+            pl_l = c31.empty()
+            sides = area.sides
+            pl.info(
+                f"Measurement area {name}, area = {area.size:.2f} / m^2, "
+                f"sides = {np.min(sides):.2f} - {np.max(sides):.2f} / m"
+            )
+            density_time = density_times[ir][::sample]
+            speed_time = speed_times[ir][::sample]
 
             # ---- plots
             # rho
             fig = plots.plot_timeserie(
-                frames,
+                frames[::sample],
                 density_time,
                 self.fps,
                 "Density / m / m",
@@ -315,7 +301,7 @@ class dvTimeSeriesClass(HydraHeadApp):
             c2.plotly_chart(fig, use_container_width=True)
             # v
             fig = plots.plot_timeserie(
-                frames,
+                frames[::sample],
                 speed_time,
                 self.fps,
                 "Speed / m/s",
@@ -327,15 +313,16 @@ class dvTimeSeriesClass(HydraHeadApp):
             # Js
             l = pl_l.slider(
                 "length",
-                float(np.min((dx, dy))),
-                float(np.max((dx, dy))),
-                0.5,
-                dx / 10,
+                float(np.min(sides)),
+                float(np.max(sides)),
+                float(np.clip(0.5, np.min(sides), np.max(sides))),
+                float(np.min(sides)) / 10,
                 help="flow = rho * v / length",
+                key=f"length_{name}",
             )
             flow = np.array(density_time) * np.array(speed_time) / l
             fig = plots.plot_timeserie(
-                frames,
+                frames[::sample],
                 flow,
                 self.fps,
                 "Js / 1/s",
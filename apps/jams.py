@@ -12,10 +12,12 @@ sys.path.append("../")
 
 
 class JamClass(HydraHeadApp):
-    def __init__(self, data, fps):
+    def __init__(self, data, agents, frame_index, fps):
         self.data: npt.NDArray[np.float64] = data
-        self.frames: npt.NDArray[np.int16] = np.unique(self.data[:, 1])
-        self.peds: npt.NDArray[np.int16] = np.unique(data[:, 0]).astype(int)
+        self.agents = agents
+        self.frame_index = frame_index
+        self.frames: npt.NDArray[np.int16] = frame_index.frames
+        self.peds: npt.NDArray[np.int16] = agents.ids
         self.fps: int = fps
 
     def init_sidebar(self):
@@ -88,14 +90,14 @@ class JamClass(HydraHeadApp):
         jam_frames = Utilities.jam_frames(self.data, jam_speed)
         with Utilities.profile("jam_lifetime"):
             lifetime, chuncks, max_lifetime, from_to = Utilities.jam_lifetime(
-                self.data, jam_frames[10:], min_jam_agents, self.fps, precision
+                self.frame_index, jam_frames[10:], min_jam_agents, self.fps, precision
             )  # remove the first frames, cause in simulation people stand
 
         ## duration
         logging.info(f"waiting time with {min_jam_time}")
         with Utilities.profile("jam_waiting_time"):
             waiting_time = Utilities.jam_waiting_time(
-                self.data, jam_speed, min_jam_time, self.fps, precision
+                self.data, self.agents, jam_speed, min_jam_time, self.fps, precision
             )
 
         if not waiting_time.size:
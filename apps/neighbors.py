@@ -12,16 +12,28 @@ import Utilities
 
 
 class NeighborsClass(HydraHeadApp):
-    def __init__(self, data, geominX, geomaxX, geominY, geomaxY, geometry_wall):
+    def __init__(
+        self,
+        data,
+        agents,
+        frame_index,
+        geominX,
+        geomaxX,
+        geominY,
+        geomaxY,
+        geometry_wall,
+    ):
         # self.fps = fps
         self.data = data
-        self.frames = np.unique(self.data[:, 1])
+        self.agents = agents
+        self.frame_index = frame_index
+        self.frames = frame_index.frames
         self.geominX = geominX
         self.geomaxX = geomaxX
         self.geominY = geominY
         self.geomaxY = geomaxY
         self.geo_walls = geometry_wall
-        self.peds = np.unique(self.data[:, 0]).astype(int)
+        self.peds = agents.ids
         self.single_file = False
 
     def init_sidebar(self):
@@ -37,7 +49,7 @@ class NeighborsClass(HydraHeadApp):
             help="See data of this Agent",
         )
 
-        dd = self.data[self.data[:, 0] == agent][:, 1]        
+        dd = self.agents.rows(self.data, agent)[:, 1]
         frame = c03.slider(
             "Frame",
             int(np.min(dd)),
@@ -88,12 +100,12 @@ class NeighborsClass(HydraHeadApp):
             k = 2
 
         nearest_dist, nearest_ind = Utilities.get_neighbors_at_frame(
-            frame, self.data, k
+            frame, self.data, self.frame_index, k
         )
 
         pdf_At_frame = Utilities.get_neighbors_pdf(nearest_dist[:, 1:].flatten())
         neighbors, neighbors_ids, area, agent_distances, agent_speeds = Utilities.get_neighbors_special_agent_data(
-            agent, frame, self.data, nearest_dist, nearest_ind
+            agent, frame, self.data, self.frame_index, nearest_dist, nearest_ind
         )        
         areas = []
         Speeds = np.array([])
@@ -103,13 +115,11 @@ class NeighborsClass(HydraHeadApp):
         c0 = np.exp(-1.5)
         for fr in self.frames:
             nearest_dist0, nearest_ind0 = Utilities.get_neighbors_at_frame(
-                fr, self.data, k
+                fr, self.data, self.frame_index, k
             )
-            at_frame = self.data[self.data[:, 1] == frame]
-            Ids = at_frame[:, 0]            
             if nearest_dist0.shape[0] > 2:
                 _neighbors, _ids, area, agent_dists, agent_speeds = Utilities.get_neighbors_special_agent_data(
-                    agent, fr, self.data, nearest_dist0, nearest_ind0
+                    agent, fr, self.data, self.frame_index, nearest_dist0, nearest_ind0
                 )                
                 C = np.hstack((C, np.sum(np.exp(-agent_dists))))
                 areas.append(area)
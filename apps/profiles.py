@@ -1,10 +1,14 @@
 import sys
+import time
 
 sys.path.append("../")
+import lovely_logger as logging
 import numpy as np
 import streamlit as st
 from hydralit import HydraHeadApp
 
+import cache
+import data_structure
 import doc
 import plots
 import numpy.typing as npt
@@ -15,19 +19,30 @@ import Utilities
 
 class ProfileClass(HydraHeadApp):
     def __init__(
-        self, data, how_speed, geometry_wall, geominX, geomaxX, geominY, geomaxY, fps
+        self,
+        data,
+        frame_index,
+        how_speed,
+        geometry_wall,
+        geominX,
+        geomaxX,
+        geominY,
+        geomaxY,
+        fps,
     ):
 
         self.how_speed: str = how_speed
         self.fps: float = fps
         self.data: npt.NDArray[np.float64] = data
+        self.frame_index = frame_index
+        self.frames: npt.NDArray[np.float64] = frame_index.frames
         self.geominX: float = geominX
         self.geomaxX: float = geomaxX
         self.geominY: float = geominY
         self.geomaxY: float = geomaxY
         self.geometry_wall = geometry_wall
 
-    def init_sidebar(self):
+    def init_sidebar(self, frames):
         # st.sidebar.header("🔴 Heatmaps")
         # prfx = st.sidebar.expander("Options")
         # choose_dprofile = c1.checkbox(
@@ -54,6 +69,13 @@ class ProfileClass(HydraHeadApp):
         dx = st.sidebar.slider(
             "Grid size", 0.1, 4.0, 1.0, step=0.2, help="Space discretization"
         )
+        frame_range = st.sidebar.slider(
+            "Frames",
+            int(frames[0]),
+            int(frames[-1]),
+            (int(frames[0]), int(frames[-1])),
+            help="Average over these frames",
+        )
         # methods = ["nearest", "gaussian", "sinc", "bicubic", "mitchell", "bilinear"]
         methods = ["off", "on"]
         interpolation = st.sidebar.radio(
@@ -68,11 +90,137 @@ class ProfileClass(HydraHeadApp):
         #      unsafe_allow_html=True,
         # )
 
-        return choose_d_method, dx, width, interpolation
+        time_resolved = st.sidebar.checkbox(
+            "Time resolved", help="Show density and speed in time windows"
+        )
+        if time_resolved:
+            window = st.sidebar.slider(
+                "Time window / s", 0.5, 30.0, 2.0, step=0.5, help="Length of a window"
+            )
+        else:
+            window = 0
+
+        return (
+            choose_d_method,
+            dx,
+            width,
+            interpolation,
+            frame_range,
+            max(int(window * self.fps), 1),
+            time_resolved,
+        )
+
+    def calculate_profiles(self, choose_d_method, dx, width, frame_range):
+        """Density and speed profiles, cached in cache.profiles"""
+
+        xbins = np.arange(self.geominX, self.geomaxX + dx, dx)
+        ybins = np.arange(self.geominY, self.geomaxY + dx, dx)
+        # the grid depends on the geometry, which is not part of data_key
+        key = (
+            st.session_state.data_key,
+            choose_d_method,
+            xbins.tobytes(),
+            ybins.tobytes(),
+            width if choose_d_method == "Gaussian" else None,
+            frame_range,
+            st.session_state.speed_index,
+        )
+        profiles = cache.profiles.get(key)
+        logging.info(cache.profiles.stats())
+        if profiles is not None:
+            return profiles
+
+        data = self.data
+        if frame_range != (self.frames[0], self.frames[-1]):
+            in_range = (data[:, 1] >= frame_range[0]) & (data[:, 1] <= frame_range[1])
+            data = data[in_range]
+
+        nframes = np.sum(
+            (self.frames >= frame_range[0]) & (self.frames <= frame_range[1])
+        )
+        bins = None
+        if choose_d_method != "Gaussian":
+            with Utilities.profile("grid bins"):
+                bins = data_structure.GridBins.cached(
+                    (st.session_state.data_key, frame_range),
+                    data[:, 2],
+                    data[:, 3],
+                    xbins,
+                    ybins,
+                )
+
+        if choose_d_method == "Weidmann":
+            density_ret = Utilities.calculate_density_average_weidmann(
+                self.geominX,
+                self.geomaxX,
+                self.geominY,
+                self.geomaxY,
+                dx,
+                dx,
+                data[:, 2],
+                data[:, 3],
+                data[:, st.session_state.speed_index],
+                bins,
+            )
+        elif choose_d_method == "Gaussian":
+            with Utilities.profile("density profile gauss"):
+                density_ret = Utilities.calculate_density_average_gauss(
+                    self.geominX,
+                    self.geomaxX,
+                    self.geominY,
+                    self.geomaxY,
+                    dx,
+                    dx,
+                    nframes,
+                    width,
+                    data[:, 2],
+                    data[:, 3],
+                )
+        else:
+            density_ret = Utilities.calculate_density_average_classic(
+                self.geominX,
+                self.geomaxX,
+                self.geominY,
+                self.geomaxY,
+                dx,
+                dx,
+                nframes,
+                data[:, 2],
+                data[:, 3],
+                bins,
+            )
+
+        if choose_d_method == "Gaussian":
+            speed_ret = Utilities.weidmann(density_ret)
+        else:
+            speed_ret = Utilities.calculate_speed_average(
+                self.geominX,
+                self.geomaxX,
+                self.geominY,
+                self.geomaxY,
+                dx,
+                dx,
+                data[:, 2],
+                data[:, 3],
+                data[:, st.session_state.speed_index],
+                bins,
+            )
+
+        speed = data[:, st.session_state.speed_index]
+        profiles = (density_ret, speed_ret, np.min(speed), np.max(speed))
+        cache.profiles.put(key, profiles)
+        return profiles
 
     def run(self):
-        choose_d_method, dx, width, interpolation = ProfileClass.init_sidebar(self)
-        frames = np.unique(self.data[:, 1])
+        (
+            choose_d_method,
+            dx,
+            width,
+            interpolation,
+            frame_range,
+            window,
+            time_resolved,
+        ) = ProfileClass.init_sidebar(self, self.frames)
         info_profile = st.expander(
             "Documentation: Density/Speed maps (click to expand)"
         )
@@ -82,49 +230,15 @@ class ProfileClass(HydraHeadApp):
         c1, c2 = st.columns((1, 1))
         Utilities.check_shape_and_stop(self.data.shape[1], self.how_speed)
         msg = ""
-        density_ret = None
         if True:
             xbins = np.arange(self.geominX, self.geomaxX + dx, dx)
             ybins = np.arange(self.geominY, self.geomaxY + dx, dx)
-            if choose_d_method == "Weidmann":
-                density_ret = Utilities.calculate_density_average_weidmann(
-                    self.geominX,
-                    self.geomaxX,
-                    self.geominY,
-                    self.geomaxY,
-                    dx,
-                    dx,
-                    self.data[:, 2],
-                    self.data[:, 3],
-                    self.data[:, st.session_state.speed_index],
-                )
-            elif choose_d_method == "Gaussian":
-                with Utilities.profile("density profile gauss"):
-                    density_ret = Utilities.calculate_density_average_gauss(
-                        self.geominX,
-                        self.geomaxX,
-                        self.geominY,
-                        self.geomaxY,
-                        dx,
-                        dx,
-                        len(frames),
-                        width,
-                        self.data[:, 2],
-                        self.data[:, 3],
-                    )
-            elif choose_d_method == "Classical":
-                density_ret = np.zeros((len(ybins) - 1, len(xbins) - 1))
-                density_ret = Utilities.calculate_density_average_classic(
-                    self.geominX,
-                    self.geomaxX,
-                    self.geominY,
-                    self.geomaxY,
-                    dx,
-                    dx,
-                    len(frames),
-                    self.data[:, 2],
-                    self.data[:, 3],
-                )
+            (
+                density_ret,
+                speed_ret,
+                min_speed,
+                max_speed,
+            ) = self.calculate_profiles(choose_d_method, dx, width, frame_range)
             st.session_state.density = density_ret
             msg += f"Density profile in range [{np.min(density_ret):.2f} : {np.max(density_ret):.2f}] [1/m^2]. \n"
             fig = plots.plot_profile_and_geometry2(
@@ -142,21 +256,6 @@ class ProfileClass(HydraHeadApp):
                 vmax=None,
             )
             c1.plotly_chart(fig, use_container_width=True)
-            if choose_d_method == "Gaussian":
-                speed_ret = Utilities.weidmann(st.session_state.density)
-            else:
-                speed_ret = Utilities.calculate_speed_average(
-                    self.geominX,
-                    self.geomaxX,
-                    self.geominY,
-                    self.geomaxY,
-                    dx,
-                    dx,
-                    self.data[:, 2],
-                    self.data[:, 3],
-                    self.data[:, st.session_state.speed_index],
-                )
-
             fig = plots.plot_profile_and_geometry2(
                 xbins,
                 ybins,
@@ -173,8 +272,133 @@ class ProfileClass(HydraHeadApp):
             )
             c2.plotly_chart(fig, use_container_width=True)
 
-            speed = self.data[:, st.session_state.speed_index]
             msg += f"Speed profile in range [{np.min(speed_ret):.2f} : {np.max(speed_ret):.2f}] [m/s]. "
-            msg += f"Speed trajectory in range [{np.min(speed):.2f} : {np.max(speed):.2f}] [m/s]. "
+            msg += (
+                f"Speed trajectory in range [{min_speed:.2f} : {max_speed:.2f}] [m/s]. "
+            )
 
             st.info(msg)
+
+        if time_resolved:
+            self.show_cube(dx, window, interpolation)
+
+    def calculate_cube(self, dx, window):
+        """Density and speed in time windows, cached in cache.profiles"""
+
+        xbins = np.arange(self.geominX, self.geomaxX + dx, dx)
+        ybins = np.arange(self.geominY, self.geomaxY + dx, dx)
+        key = (
+            st.session_state.data_key,
+            "cube",
+            xbins.tobytes(),
+            ybins.tobytes(),
+            window,
+            st.session_state.speed_index,
+        )
+        cube = cache.profiles.get(key)
+        if cube is not None:
+            return cube
+
+        with Utilities.profile("density speed cube"):
+            bins = data_structure.GridBins.cached(
+                (
+                    st.session_state.data_key,
+                    (int(self.frames[0]), int(self.frames[-1])),
+                ),
+                self.data[:, 2],
+                self.data[:, 3],
+                xbins,
+                ybins,
+            )
+            starts, density, speed = Utilities.density_speed_cube(
+                bins,
+                self.data[:, 1],
+                self.data[:, st.session_state.speed_index],
+                self.frames,
+                window,
+                dx * dx,
+            )
+
+        cube = (starts, density, speed, np.max(density), np.nanmax(speed))
+        cache.profiles.put(key, cube)
+        return cube
+
+    def show_cube(self, dx, window, interpolation):
+        """Heatmaps of one time window; only this window is sent to the browser"""
+
+        xbins = np.arange(self.geominX, self.geomaxX + dx, dx)
+        ybins = np.arange(self.geominY, self.geomaxY + dx, dx)
+        # the cube must fit into cache.profiles, otherwise it would be
+        # calculated again on every rerun
+        fitted = Utilities.cube_window_for_size(
+            self.frames,
+            window,
+            (len(xbins) - 1) * (len(ybins) - 1),
+            cache.profiles.max_bytes,
+        )
+        if fitted is None:
+            st.warning(
+                "Grid too fine for time resolved profiles. Increase the grid size."
+            )
+            return
+
+        if fitted != window:
+            msg = (
+                f"Time window increased from {window / self.fps:.1f} s to "
+                f"{fitted / self.fps:.1f} s to keep the time resolved profiles "
+                f"below {cache.profiles.max_bytes / 1024**2:.0f} MB"
+            )
+            logging.warning(msg)
+            st.warning(msg)
+            window = fitted
+
+        starts, density, speed, max_density, max_speed = self.calculate_cube(dx, window)
+        st.markdown("### :hourglass_flowing_sand: Time resolved profiles")
+        c0, c1, c2 = st.columns((1, 4, 4))
+        play = c0.button("▶️ Play", help="Show all following time windows")
+        k = st.slider(
+            "Time window",
+            0,
+            len(starts) - 1,
+            0,
+            format="window %d",
+            help=f"Time window of {window / self.fps:.1f} s",
+        )
+        density_plot = c1.empty()
+        speed_plot = c2.empty()
+        for i in range(k, len(starts) if play else k + 1):
+            time_range = (
+                f"{starts[i] / self.fps:.1f} - {(starts[i] + window) / self.fps:.1f} s"
+            )
+            fig = plots.plot_profile_and_geometry2(
+                xbins,
+                ybins,
+                self.geometry_wall,
+                None,
+                None,
+                None,
+                density[i],
+                interpolation,
+                label=r"1/m/m",
+                title=f"Density {time_range}",
+                vmin=0,
+                vmax=max_density,
+            )
+            density_plot.plotly_chart(fig, use_container_width=True)
+            fig = plots.plot_profile_and_geometry2(
+                xbins,
+                ybins,
+                self.geometry_wall,
+                None,
+                None,
+                None,
+                speed[i],
+                interpolation,
+                label=r"v / m/s",
+                title=f"Speed {time_range}",
+                vmin=0,
+                vmax=max_speed,
+            )
+            speed_plot.plotly_chart(fig, use_container_width=True)
+            if play:
+                time.sleep(0.2)
@@ -1,6 +1,7 @@
 import sys
 from typing import Dict
 
+import data_structure
 import doc
 import numpy as np
 import numpy.typing as npt
@@ -56,6 +57,9 @@ class RsetClass(HydraHeadApp):
 
         xbins = np.arange(self.geominX, self.geomaxX + dx, dx)
         ybins = np.arange(self.geominY, self.geomaxY + dx, dx)
+        bins = data_structure.GridBins.cached(
+            st.session_state.data_key, self.data[:, 2], self.data[:, 3], xbins, ybins
+        )
         # RSET
         rset_max = Utilities.calculate_RSET(
             self.geominX,
@@ -68,6 +72,7 @@ class RsetClass(HydraHeadApp):
             self.data[:, 3],
             self.data[:, 1] / self.fps,
             "max",
+            bins,
         )
 
         nbins = c2.slider(
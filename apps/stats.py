@@ -3,7 +3,6 @@ import sys
 sys.path.append("../")
 import logging
 
-import numpy as np
 import streamlit as st
 from hydralit import HydraHeadApp
 
@@ -12,17 +11,18 @@ import Utilities
 
 
 class StatClass(HydraHeadApp):
-    def __init__(self, data, unit, fps, header_traj):
+    def __init__(self, data, agents, frame_index, unit, fps, header_traj):
         self.unit = unit
         self.fps = fps
         self.data = data
+        self.agents = agents
+        self.frame_index = frame_index
         self.header_traj = header_traj
 
     def run(self):
         st.markdown("### :round_pushpin: Summary of the trajectory data")
-        frames = np.unique(self.data[:, 1])
-        peds = np.unique(self.data[:, 0]).astype(int)
-        nagents = len(peds)
+        frames = self.frame_index.frames
+        nagents = len(self.agents)
         msg = f"""
         Header: {self.header_traj}\n
         Unit: {self.unit}\n
@@ -30,7 +30,7 @@ class StatClass(HydraHeadApp):
         """
         c1, c2, c3 = st.columns((1, 1, 1))
         c1.metric(label="Agents: ", value=nagents)
-        c2.metric("Time: ", f"{np.max(frames) / self.fps:.2f} [s]")
+        c2.metric("Time: ", f"{frames[-1] / self.fps:.2f} [s]")
         c3.metric(label="Frames: ", value=len(frames), delta=int(frames[-1]))
         st.info(msg)
 
@@ -1,25 +1,38 @@
 import datetime as dt
+import os
 import sys
 
+import cache
 import doc
-import numpy as np  # typing: ignore
 import plots
 import streamlit as st  # typing: ignore
 import Utilities
 from hydralit import HydraHeadApp  # typing: ignore
-from shapely.geometry import LineString
 
 sys.path.append("../")
 
 
 class TimeSeriesClass(HydraHeadApp):
     def __init__(
-        self, data, disable_NT_flow, transitions, default, fps, name, group_index
+        self,
+        data,
+        agents,
+        frame_index,
+        segment_grid,
+        disable_NT_flow,
+        transitions,
+        default,
+        fps,
+        name,
+        group_index,
     ):
         self.data = data
+        self.agents = agents
+        self.frame_index = frame_index
+        self.segment_grid = segment_grid
         self.disable_NT_flow = disable_NT_flow
-        self.frames = np.unique(self.data[:, 1])
-        self.peds = np.unique(data[:, 0]).astype(int)
+        self.frames = frame_index.frames
+        self.peds = agents.ids
         self.transitions = transitions
         self.default = default
         self.fps = fps
@@ -64,6 +77,16 @@ class TimeSeriesClass(HydraHeadApp):
             disabled=self.disable_NT_flow,
             key="Survival",
         )
+        if choose_flow:
+            flow_windows = st.sidebar.multiselect(
+                "Flow windows / s",
+                [1, 2, 5, 10, 20, 30, 60],
+                [5, 10],
+                help="Window sizes of the flow in sliding windows",
+            )
+        else:
+            flow_windows = []
+
         if choose_time_distance:
             num_peds_TD = st.sidebar.number_input(
                 "number pedestrians",
@@ -91,6 +114,14 @@ class TimeSeriesClass(HydraHeadApp):
             self.default,
             help="Transition to calculate N-T. Can select multiple transitions",
         )
+        workers = st.sidebar.number_input(
+            "Workers",
+            min_value=1,
+            max_value=os.cpu_count() or 1,
+            value=1,
+            step=1,
+            help="Number of processes to calculate N-T (1: no parallelisation)",
+        )
 
         return (
             selected_transitions,
@@ -101,6 +132,8 @@ class TimeSeriesClass(HydraHeadApp):
             choose_speed_PDF,
             num_peds_TD,
             sample_TD,
+            workers,
+            flow_windows,
         )
 
     def run(self):
@@ -113,6 +146,8 @@ class TimeSeriesClass(HydraHeadApp):
             choose_speed_PDF,
             num_peds_TD,
             sample_TD,
+            workers,
+            flow_windows,
         ) = TimeSeriesClass.init_sidebar(self)
         plot_options = (
             choose_NT or choose_flow or choose_time_distance or choose_survival
@@ -123,7 +158,6 @@ class TimeSeriesClass(HydraHeadApp):
 
         # all these options need to calculate N-T-Data
         if plot_options:
-            # todo: cache calculation in st.session_state.tstats
             with Utilities.profile("calculate_NT_data"):
                 (
                     tstats,
@@ -137,12 +171,18 @@ class TimeSeriesClass(HydraHeadApp):
                     self.transitions,
                     selected_transitions,
                     self.data,
+                    self.agents,
                     self.fps,
+                    self.segment_grid,
+                    cache.crossings,
+                    # crossings depend on positions only, not on df
+                    st.session_state.data_key[:2],
+                    int(workers),
                 )
 
         c1, c2 = st.columns((1, 1))
         if choose_NT:
-            peds_inside = Utilities.peds_inside(self.data)
+            peds_inside = Utilities.peds_inside(self.frame_index)
             fig1 = plots.plot_peds_inside(self.frames, peds_inside, self.fps)
             c2.plotly_chart(fig1, use_container_width=True)
             if tstats:
@@ -157,6 +197,22 @@ class TimeSeriesClass(HydraHeadApp):
                 )
                 c2.plotly_chart(fig, use_container_width=True)
 
+        flow_J = {}
+        if choose_flow and tstats and flow_windows:
+            with Utilities.profile("flow series"):
+                (flow_times, flow_J, flow_J_mean, flow_J_std,) = Utilities.flow_series(
+                    tstats,
+                    self.fps,
+                    flow_windows,
+                    int(self.frames[0]),
+                    int(self.frames[-1]),
+                )
+            if flow_J:
+                fig = plots.plot_flow_series(
+                    flow_times, flow_J, flow_J_mean, flow_J_std, flow_windows
+                )
+                c1.plotly_chart(fig, use_container_width=True)
+
         if choose_speed_PDF:
             fig = plots.plot_vpdf(self.data)
             c1.plotly_chart(fig, use_container_width=True)
@@ -175,7 +231,8 @@ class TimeSeriesClass(HydraHeadApp):
                         fig = plots.plot_time_distance(
                             Frames,
                             self.data,
-                            LineString(self.transitions[i]),
+                            self.agents,
+                            self.transitions[i],
                             i,
                             self.fps,
                             num_peds_TD,
@@ -195,69 +252,21 @@ class TimeSeriesClass(HydraHeadApp):
 
         # -- download stats
         if choose_NT:
-            T = dt.datetime.now()
-
-            file_download = f"stats_{self.name}_{T.year}-{T.month:02}-{T.day:02}_{T.hour:02}-{T.minute:02}-{T.second:02}.txt"
-            once = 0  # don't download if file is empty
-            for i in selected_transitions:
-                if not trans_used[i]:
-                    continue
-
-                nrows = tstats[i].shape[0]
-                if nrows < max_len:
-                    tmp_stats = np.full((max_len, 3), -1)
-                    tmp_stats[:nrows, :] = tstats[i]
-                    tmp_cum_num = np.full(max_len, -1)
-                    tmp_cum_num[: len(cum_num[i])] = cum_num[i]
-                else:
-                    tmp_stats = tstats[i]
-                    tmp_cum_num = cum_num[i]
-
-                tmp_cum_num_p = np.full(len(tmp_cum_num), -1)
-                tmp_cum_num_p[: len(cum_num_positiv[i])] = cum_num_positiv[i]
-                tmp_cum_num_n = np.full(len(tmp_cum_num), -1)
-                tmp_cum_num_n[: len(cum_num_negativ[i])] = cum_num_negativ[i]
-
-                tmp_cum_num = tmp_cum_num.reshape(len(tmp_cum_num), 1)
-                tmp_cum_num_p = tmp_cum_num_p.reshape(len(tmp_cum_num_p), 1)
-                tmp_cum_num_n = tmp_cum_num_n.reshape(len(tmp_cum_num_n), 1)
-                if not once:
-                    all_stats = np.hstack(
-                        (tmp_stats, tmp_cum_num, tmp_cum_num_p, tmp_cum_num_n)
-                    )
-                    once = 1
-                else:
-                    all_stats = np.hstack(
-                        (
-                            all_stats,
-                            tmp_stats,
-                            tmp_cum_num,
-                            tmp_cum_num_p,
-                            tmp_cum_num_n,
-                        )
-                    )
+            passed_lines = [i for i in selected_transitions if trans_used[i]]
+            if passed_lines:
+                T = dt.datetime.now()
+                fmt = st.sidebar.selectbox(
+                    "Statistics format",
+                    ["csv", "npz"],
+                    help="csv: crossings, then the flow in sliding windows. npz: numpy arrays",
+                )
+                file_download = f"stats_{self.name}_{T.year}-{T.month:02}-{T.day:02}_{T.hour:02}-{T.minute:02}-{T.second:02}.{fmt}"
+                flow = None
+                if flow_J:
+                    flow = (flow_times, flow_J, flow_J_mean, flow_J_std, flow_windows)
 
-            if selected_transitions and once:
-                passed_lines = [i for i in selected_transitions if trans_used[i]]
-                fmt = len(passed_lines) * ["%d", "%d", "%d", "%d", "%d", "%d"]
-                # all_stats = all_stats.T
-                np.savetxt(
-                    file_download,
-                    all_stats,
-                    fmt=fmt,
-                    header="line ids: \n"
-                    + np.array2string(
-                        np.array(passed_lines, dtype=int),
-                        precision=2,
-                        separator="\t",
-                        suppress_small=True,
-                    )
-                    + f"\nframerate: {self.fps:.0f}"
-                    + "\npid\tframe\tdirection\tcount_tot\tcount+\tcount-",
-                    comments="#",
-                    delimiter="\t",
+                st.sidebar.download_button(
+                    "Download statistics",
+                    Utilities.export_stats(tstats, passed_lines, self.fps, fmt, flow),
+                    file_name=file_download,
                 )
-                with open(file_download, encoding="utf-8") as f:
-                    st.sidebar.download_button(
-                        "Download statistics", f, file_name=file_download
-                    )
@@ -13,6 +13,8 @@ class TrajClass(HydraHeadApp):
     def __init__(
         self,
         data,
+        agents,
+        frame_index,
         data_df,
         how_speed,
         geometry_wall,
@@ -28,6 +30,8 @@ class TrajClass(HydraHeadApp):
         self.how_speed = how_speed
         self.fps = fps
         self.data = data
+        self.agents = agents
+        self.frames = frame_index.frames
         self.data_df = data_df
         self.geominX = geominX
         self.geomaxX = geomaxX
@@ -37,8 +41,7 @@ class TrajClass(HydraHeadApp):
         self.choose_transitions = True
         self.transitions = transitions
         self.sample_trajectories = 1
-        self.frames = np.unique(self.data[:, 1])
-        self.peds = np.unique(data[:, 0]).astype(int)
+        self.peds = agents.ids
         nagents = len(self.peds)
 
         if nagents <= 10:
@@ -65,7 +68,7 @@ class TrajClass(HydraHeadApp):
         sample_trajectories = st.sidebar.number_input(
             "Sample rate",
             min_value=1,
-            max_value=int(np.max(self.frames * 0.2)),
+            max_value=int(self.frames[-1] * 0.2),
             value=10,
             step=5,
             help="Sample rate of ploting trajectories and time series \
@@ -88,7 +91,7 @@ class TrajClass(HydraHeadApp):
         TrajClass.init_sidebar(self)
         sample_trajectories = self.sample_trajectories
         if self.show_special_agent_stats:
-            agent = self.data[self.data[:, 0] == self.plot_ped]
+            agent = self.agents.rows(self.data, self.plot_ped)
             speed_agent = agent[:, st.session_state.speed_index]
             if self.how_speed == "from simulation":
                 angle_agent = agent[:, 7]
@@ -105,6 +108,7 @@ class TrajClass(HydraHeadApp):
         with Utilities.profile("plot_trajectories"):
             fig = plots.plot_trajectories(
                 self.data,
+                self.agents,
                 self.plot_ped,
                 speed_agent,
                 self.geometry_wall,
@@ -122,7 +126,8 @@ class TrajClass(HydraHeadApp):
             with Utilities.profile("moving_trajectories"):
                 fig = plots.moving_trajectories(
                     self.data,
-                    self.data_df,
+                    self.agents,
+                    self.data_df.get(),
                     self.plot_ped,
                     speed_agent,
                     self.geometry_wall,
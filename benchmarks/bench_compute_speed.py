@@ -0,0 +1,101 @@
+"""Benchmark Utilities.compute_speed_and_angle against the per-agent loop
+
+Usage:
+    python benchmarks/bench_compute_speed.py [--rows 1e6 1e7 5e7] [--legacy-max-rows 1e6]
+
+The legacy loop grows the result with np.vstack once per agent, so its
+runtime is quadratic in the number of agents. It is skipped for sizes
+above --legacy-max-rows.
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+import data_structure  # noqa: E402
+import Utilities  # noqa: E402
+
+
+def compute_speed_and_angle_loop(data, agents, fps, df=10):
+    """Previous implementation: one np.vstack per agent"""
+
+    once = 1
+    data2 = np.array([])
+    for _, rows in agents:
+        ped = data[rows]
+        traj = ped[:, 2:4]
+        size = traj.shape[0]
+        speed = np.ones(size)
+        angle = np.zeros(size)
+        if size >= df:
+            delta = traj[df:, :] - traj[: size - df, :]
+            angle[: size - df] = np.arctan2(delta[:, 1], delta[:, 0]) * 180 / np.pi
+            speed[: size - df] = np.sqrt(np.sum(np.square(delta), axis=1)) / df * fps
+            speed[size - df :] = speed[size - df - 1]
+            angle[size - df :] = angle[size - df - 1]
+
+        ped = np.hstack((ped, angle.reshape(size, 1), speed.reshape(size, 1)))
+        if once:
+            data2 = ped
+            once = 0
+        else:
+            data2 = np.vstack((data2, ped))
+
+    return data2
+
+
+def make_data(num_rows, frames_per_agent=1000, seed=0):
+    """Trajectories sorted by (ID, FR) with 5 columns: ID FR X Y Z"""
+
+    rng = np.random.default_rng(seed)
+    num_agents = max(1, num_rows // frames_per_agent)
+    data = np.empty((num_rows, 5))
+    data[:, 0] = np.minimum(np.arange(num_rows) // frames_per_agent, num_agents - 1)
+    data[:, 1] = np.arange(num_rows) - data[:, 0] * frames_per_agent
+    data[:, 2] = rng.normal(0.05, 0.02, num_rows).cumsum()
+    data[:, 3] = rng.normal(0, 0.02, num_rows).cumsum()
+    data[:, 4] = 0
+    return data
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=float, nargs="+", default=[1e6, 1e7, 5e7])
+    parser.add_argument("--legacy-max-rows", type=float, default=1e6)
+    parser.add_argument("--fps", type=int, default=16)
+    parser.add_argument("--df", type=int, default=10)
+    args = parser.parse_args()
+
+    print(
+        f"{'rows':>12} {'agents':>8} {'vectorized/s':>13} {'loop/s':>10} {'speedup':>8}"
+    )
+    for num_rows in map(int, args.rows):
+        data = make_data(num_rows)
+        agents = data_structure.AgentIndex.from_sorted(data)
+        t_new, result = timed(
+            Utilities.compute_speed_and_angle, data, agents, args.fps, args.df
+        )
+        if num_rows <= args.legacy_max_rows:
+            t_old, expected = timed(
+                compute_speed_and_angle_loop, data, agents, args.fps, args.df
+            )
+            assert np.allclose(result, expected)
+            old, speedup = f"{t_old:10.2f}", f"{t_old / t_new:8.1f}"
+        else:
+            old, speedup = f"{'skipped':>10}", f"{'-':>8}"
+
+        print(f"{num_rows:12d} {len(agents):8d} {t_new:13.2f} {old} {speedup}")
+        del data, result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Benchmark Utilities.crossing_events for N-T curves
+
+Usage:
+    python benchmarks/bench_crossings.py [--agents 10000] [--frames 500] [--lines 20]
+        [--workers 4]
+
+Agents walk in +x through a corridor crossed by equally spaced vertical
+measurement lines. With --workers > 1, crossing_events_parallel is timed
+as well, the second call reusing the worker pool and the shared data.
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+import data_structure  # noqa: E402
+import Utilities  # noqa: E402
+
+
+def make_data(num_agents, num_frames, seed=0):
+    """Trajectories sorted by (ID, FR) with 5 columns: ID FR X Y Z"""
+
+    rng = np.random.default_rng(seed)
+    num_rows = num_agents * num_frames
+    data = np.empty((num_rows, 5))
+    data[:, 0] = np.repeat(np.arange(num_agents), num_frames)
+    data[:, 1] = np.tile(np.arange(num_frames), num_agents)
+    step = rng.normal(0.08, 0.03, (num_agents, num_frames))
+    data[:, 2] = (step.cumsum(axis=1) + rng.uniform(-5, 0, (num_agents, 1))).ravel()
+    data[:, 3] = np.repeat(rng.uniform(0, 10, num_agents), num_frames)
+    data[:, 4] = 0
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--agents", type=int, default=10000)
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--lines", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    data = make_data(args.agents, args.frames)
+    agents = data_structure.AgentIndex.from_sorted(data)
+    lines = [np.array([[x, 0.0], [x, 10.0]]) for x in np.linspace(0, 30, args.lines)]
+    start = time.perf_counter()
+    events = Utilities.crossing_events(data, agents, lines)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{args.agents} agents x {args.frames} frames, {args.lines} lines: "
+        f"{len(events)} crossings in {elapsed:.3f} s"
+    )
+    if args.workers < 2:
+        return
+
+    grid = data_structure.SegmentGrid.from_sorted(data, agents)
+    for run in ("first call", "second call"):
+        start = time.perf_counter()
+        parallel = Utilities.crossing_events_parallel(
+            data, agents, lines, args.workers, grid=grid, dataset="bench"
+        )
+        elapsed = time.perf_counter() - start
+        assert np.array_equal(parallel, events)
+        print(f"{args.workers} workers, {run}: {elapsed:.3f} s")
+
+
+# required: the workers of crossing_events_parallel import this module.
+# Without the guard they would run main() again, the pool breaks and the
+# parallel timings silently measure the serial fallback
+if __name__ == "__main__":
+    main()
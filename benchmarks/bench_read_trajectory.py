@@ -0,0 +1,95 @@
+"""Benchmark Utilities.read_trajectory against decoding and parsing at once
+
+Usage:
+    python benchmarks/bench_read_trajectory.py [--rows 1e6 1e7] [--chunk-rows 262144]
+
+Each reader runs in a fresh process, so the reported peak RSS belongs to
+that reader only. "legacy" reproduces the previous path: the upload is
+decoded to a str and read_csv parses the whole file in one go.
+"""
+import argparse
+import io
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from pandas import read_csv
+
+sys.path.append(str(Path(__file__).parent.parent))
+import Utilities  # noqa: E402
+
+
+def write_data(path, num_rows, frames_per_agent=1000, seed=0):
+    """Trajectory file with header and columns ID FR X Y Z"""
+
+    rng = np.random.default_rng(seed)
+    data = np.empty((num_rows, 5))
+    data[:, 0] = np.arange(num_rows) // frames_per_agent
+    data[:, 1] = np.arange(num_rows) % frames_per_agent
+    data[:, 2:4] = rng.random((num_rows, 2)) * 10
+    data[:, 4] = 0
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("#framerate: 16\n#unit: m\n#ID FR X Y Z\n")
+        np.savetxt(f, data, fmt=["%d", "%d", "%.4f", "%.4f", "%.1f"])
+
+
+def run(method, path, chunk_rows):
+    """Parse path with method, print rows, rows/s and peak RSS (MB)"""
+
+    # like an upload, the raw bytes are held in memory
+    stream = io.BytesIO(Path(path).read_bytes())
+    start = time.perf_counter()
+    if method == "chunked":
+        data = Utilities.read_trajectory(stream, chunk_rows)
+    else:
+        text = stream.getvalue().decode("utf-8")
+        data = read_csv(
+            io.StringIO(text), sep=r"\s+", dtype=np.float64, comment="#"
+        ).values
+
+    elapsed = time.perf_counter() - start
+    print(data.shape[0], data.shape[0] / elapsed, Utilities.peak_rss())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=float, nargs="+", default=[1e6, 1e7])
+    parser.add_argument("--chunk-rows", type=int, default=1 << 18)
+    parser.add_argument("--run", nargs=2, metavar=("METHOD", "FILE"), help="internal")
+    args = parser.parse_args()
+
+    if args.run:
+        run(*args.run, args.chunk_rows)
+        return
+
+    print(f"{'rows':>12} {'reader':>8} {'rows/s':>12} {'peak RSS/MB':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for num_rows in map(int, args.rows):
+            path = Path(tmp) / f"traj_{num_rows}.txt"
+            write_data(path, num_rows)
+            for method in ["legacy", "chunked"]:
+                out = subprocess.run(
+                    [
+                        sys.executable,
+                        __file__,
+                        "--chunk-rows",
+                        str(args.chunk_rows),
+                        "--run",
+                        method,
+                        str(path),
+                    ],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout.split()
+                rows, rate, rss = int(out[0]), float(out[1]), float(out[2])
+                print(f"{rows:12d} {method:>8} {rate:12.0f} {rss:12.0f}")
+
+            path.unlink()
+
+
+if __name__ == "__main__":
+    main()
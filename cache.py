@@ -0,0 +1,215 @@
+"""Caches of parsed trajectories and derived results
+
+Arrays are stored as .npy files in one directory per content hash of the
+trajectory file (see Utilities.fingerprint), so later sessions can
+memory-map them instead of parsing the text file again.
+MemoryCache keeps smaller results in memory, shared by all sessions.
+"""
+import dataclasses
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Hashable, Optional
+
+import lovely_logger as logging  # type: ignore
+import numpy as np  # type: ignore
+import numpy.typing as npt  # type: ignore
+
+import Utilities
+
+if TYPE_CHECKING:
+    from data_structure import AgentIndex
+
+CACHE_DIR = Path(
+    os.environ.get("DASHBOARD_CACHE_DIR", Path(__file__).parent / ".cache")
+)
+# evict the least recently used entries above this size
+MAX_CACHE_BYTES = int(os.environ.get("DASHBOARD_CACHE_BYTES", 4 * 1024**3))
+# and all entries not used for this many seconds
+MAX_CACHE_AGE = float(os.environ.get("DASHBOARD_CACHE_AGE", 7 * 24 * 3600))
+
+
+def load_array(digest: str, name: str) -> Optional[npt.NDArray[np.float64]]:
+    """Return read-only memory-mapped array or None if not cached"""
+
+    path = CACHE_DIR / digest / f"{name}.npy"
+    try:
+        array = np.load(path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+
+    # mark the entry as recently used for the eviction. The mapping stays
+    # valid if another session removes the entry meanwhile
+    try:
+        os.utime(path.parent)
+    except OSError:
+        pass
+
+    return array
+
+
+def store_array(digest: str, name: str, array: npt.NDArray[np.float64]) -> None:
+    """Write array to the cache and evict old entries"""
+
+    entry = CACHE_DIR / digest
+    try:
+        entry.mkdir(parents=True, exist_ok=True)
+        # unique per process and thread, so concurrent writers never share it
+        tmp = entry / f".{name}.{os.getpid()}.{threading.get_ident()}.npy"
+        np.save(tmp, array)
+        os.replace(tmp, entry / f"{name}.npy")
+    except OSError as e:
+        logging.warning(f"Could not write {name} to cache: {e}")
+        return
+
+    evict()
+
+
+def evict(max_bytes: int = MAX_CACHE_BYTES, max_age: float = MAX_CACHE_AGE) -> None:
+    """Remove entries older than max_age, then the oldest until below max_bytes"""
+
+    if not CACHE_DIR.is_dir():
+        return
+
+    now = time.time()
+    entries = []
+    for entry in CACHE_DIR.iterdir():
+        if not entry.is_dir():
+            continue
+
+        # another session may remove entries or files while we scan them
+        try:
+            mtime = entry.stat().st_mtime
+            if now - mtime > max_age:
+                logging.info(f"Cache: remove expired {entry.name}")
+                shutil.rmtree(entry, ignore_errors=True)
+                continue
+
+            size = 0
+            for f in entry.iterdir():
+                try:
+                    size += f.stat().st_size
+                except FileNotFoundError:
+                    pass
+        except FileNotFoundError:
+            continue
+
+        entries.append((mtime, size, entry))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries, key=lambda e: e[0]):
+        if total <= max_bytes:
+            break
+
+        logging.info(f"Cache: remove {entry.name} ({size / 1024**2:.1f} MB)")
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def speed_and_angle(
+    digest: str,
+    data: npt.NDArray[np.float64],
+    agents: "AgentIndex",
+    fps: int,
+    df: int,
+) -> npt.NDArray[np.float64]:
+    """Utilities.compute_speed_and_angle with cached angle and speed columns"""
+
+    name = f"angle_speed_{data.dtype}_fps{fps}_df{df}"
+    columns = load_array(digest, name)
+    if columns is not None and columns.shape[0] == data.shape[0]:
+        logging.info(f"Cache hit: {name} of {digest}")
+        return np.hstack((data, columns))
+
+    data2 = Utilities.compute_speed_and_angle(data, agents, fps, df)
+    store_array(digest, name, data2[:, -2:])
+    return data2
+
+
+def nbytes(value: Any) -> int:
+    """Approximate size of arrays and containers of arrays"""
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+
+    if dataclasses.is_dataclass(value):
+        return sum(nbytes(getattr(value, f.name)) for f in dataclasses.fields(value))
+
+    return sys.getsizeof(value)
+
+
+class MemoryCache:
+    """Least recently used cache bounded by the total size of its values"""
+
+    def __init__(self, name: str, max_bytes: int):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: Hashable) -> Any:
+        """Return value of key or None"""
+
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Store value and evict the least recently used values above max_bytes"""
+
+        size = nbytes(value)
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= nbytes(self._items.pop(key))
+
+            if size > self.max_bytes:
+                return
+
+            self._items[key] = value
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= nbytes(evicted)
+
+    def stats(self) -> str:
+        return (
+            f"{self.name}: {len(self)} entries, {self.nbytes / 1024**2:.1f} MB, "
+            f"{self.hits} hits, {self.misses} misses"
+        )
+
+
+# crossing events of each transition, see Utilities.calculate_NT_data
+crossings = MemoryCache(
+    "crossings", int(os.environ.get("DASHBOARD_CROSSINGS_BYTES", 256 * 1024**2))
+)
+# cell index of each row on the grids of the heatmaps, see data_structure.GridBins
+bins = MemoryCache("bins", int(os.environ.get("DASHBOARD_BINS_BYTES", 512 * 1024**2)))
+# rows inside measurement areas, see data_structure.MeasurementArea
+areas = MemoryCache(
+    "areas", int(os.environ.get("DASHBOARD_AREAS_BYTES", 256 * 1024**2))
+)
+# density and speed profiles, see apps.profiles.ProfileClass
+profiles = MemoryCache(
+    "profiles", int(os.environ.get("DASHBOARD_PROFILES_BYTES", 128 * 1024**2))
+)
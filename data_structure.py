@@ -1,17 +1,677 @@
+import functools
 import logging
 
 from dataclasses import dataclass, field
-from io import StringIO
-from typing import Any, List
-from xml.dom.minidom import Document, parse, parseString
+import xml.etree.ElementTree as ET
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
 from pathlib import Path
 import numpy as np
 import numpy.typing as npt
 import pandas as pd  # type: ignore
 import streamlit as st
-from pandas import read_csv
 from streamlit.uploaded_file_manager import UploadedFile
 import Utilities  # type:ignore
+import cache
+
+
+def sort_trajectories(data: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    """Return data sorted by (ID, FR). Already sorted data is returned as is"""
+
+    if data.shape[0] < 2:
+        return data
+
+    dpid = np.diff(data[:, 0])
+    dframe = np.diff(data[:, 1])
+    if np.all((dpid > 0) | ((dpid == 0) & (dframe > 0))):
+        return data
+
+    return data[np.lexsort((data[:, 1], data[:, 0]))]
+
+
+@dataclass(frozen=True)
+class AgentIndex:
+    """Rows of each agent in a trajectory array sorted by (ID, FR)
+
+    The rows of agent ids[i] are data[offsets[i] : offsets[i + 1]].
+    The index only depends on the row order, so it is valid for every
+    array derived row-wise from the sorted data (e.g. with speed columns).
+    """
+
+    ids: npt.NDArray[np.int64]
+    offsets: npt.NDArray[np.int64]
+
+    @classmethod
+    def from_sorted(cls, data: npt.NDArray[np.float64]) -> "AgentIndex":
+        """Build index from data sorted with sort_trajectories()"""
+
+        if not data.size:
+            return cls(np.array([], dtype=np.int64), np.zeros(1, dtype=np.int64))
+
+        pid = data[:, 0]
+        starts = np.flatnonzero(pid[1:] != pid[:-1]) + 1
+        offsets = np.concatenate(([0], starts, [len(pid)])).astype(np.int64)
+        ids = pid[offsets[:-1]].astype(np.int64)
+        return cls(ids, offsets)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[Tuple[int, slice]]:
+        """Yield (agent id, slice of its rows)"""
+
+        for i, ped in enumerate(self.ids):
+            yield int(ped), slice(self.offsets[i], self.offsets[i + 1])
+
+    def span(self, ped: int) -> slice:
+        """Slice of the rows of agent ped (empty if ped does not exist)"""
+
+        i = int(np.searchsorted(self.ids, ped))
+        if i < len(self.ids) and self.ids[i] == ped:
+            return slice(self.offsets[i], self.offsets[i + 1])
+
+        return slice(0, 0)
+
+    def rows(self, data: npt.NDArray[np.float64], ped: int) -> npt.NDArray[np.float64]:
+        """View on the rows of agent ped"""
+
+        return data[self.span(ped)]
+
+    def spans_until(
+        self,
+        data: npt.NDArray[np.float64],
+        peds: npt.NDArray[np.int64],
+        frames: npt.NDArray[np.float64],
+    ) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+        """Start and stop row of each agent peds[i] up to frames[i] (inclusive)
+
+        One binary search over the frames of all agents at once.
+        Agents that do not exist get empty spans.
+        """
+
+        if not len(self.ids):
+            empty = np.zeros(len(peds), dtype=np.int64)
+            return empty, empty
+
+        i = np.minimum(np.searchsorted(self.ids, peds), len(self.ids) - 1)
+        exists = self.ids[i] == peds
+        start = np.where(exists, self.offsets[i], 0)
+        lo = start.copy()
+        hi = np.where(exists, self.offsets[i + 1], 0)
+        active = lo < hi
+        while active.any():
+            mid = (lo + hi) // 2
+            before = active & (data[np.minimum(mid, len(data) - 1), 1] <= frames)
+            lo = np.where(before, mid + 1, lo)
+            hi = np.where(active & ~before, mid, hi)
+            active = lo < hi
+
+        return start, lo
+
+    def sizes(self) -> npt.NDArray[np.int64]:
+        """Number of rows of each agent"""
+
+        return np.diff(self.offsets)
+
+
+@dataclass(frozen=True)
+class FrameIndex:
+    """Rows of each frame in a trajectory array (CSR layout)
+
+    The rows of frame frames[i] are data[order[offsets[i] : offsets[i + 1]]],
+    i.e. slicing one frame costs O(rows in frame) instead of a full scan.
+    Within a frame the rows keep their order in data.
+    """
+
+    frames: npt.NDArray[np.float64]
+    order: npt.NDArray[np.int64]
+    offsets: npt.NDArray[np.int64]
+
+    @classmethod
+    def from_data(cls, data: npt.NDArray[np.float64]) -> "FrameIndex":
+        """Build index from data (any row order)"""
+
+        if not data.size:
+            return cls(
+                np.array([]), np.array([], dtype=np.int64), np.zeros(1, dtype=np.int64)
+            )
+
+        order = np.argsort(data[:, 1], kind="stable")
+        frame = data[order, 1]
+        starts = np.flatnonzero(frame[1:] != frame[:-1]) + 1
+        offsets = np.concatenate(([0], starts, [len(frame)])).astype(np.int64)
+        return cls(frame[offsets[:-1]], order.astype(np.int64), offsets)
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def __iter__(self) -> Iterator[Tuple[float, npt.NDArray[np.int64]]]:
+        """Yield (frame, indices of its rows)"""
+
+        for i, frame in enumerate(self.frames):
+            yield frame, self.order[self.offsets[i] : self.offsets[i + 1]]
+
+    def index(self, frame: float) -> npt.NDArray[np.int64]:
+        """Indices of the rows at frame (empty if frame does not exist)"""
+
+        i = int(np.searchsorted(self.frames, frame))
+        if i < len(self.frames) and self.frames[i] == frame:
+            return self.order[self.offsets[i] : self.offsets[i + 1]]
+
+        return self.order[:0]
+
+    def rows(
+        self, data: npt.NDArray[np.float64], frame: float
+    ) -> npt.NDArray[np.float64]:
+        """Rows of data at frame"""
+
+        return data[self.index(frame)]
+
+    def counts(self) -> npt.NDArray[np.int64]:
+        """Number of rows in each frame"""
+
+        return np.diff(self.offsets)
+
+    @functools.cached_property
+    def positions(self) -> npt.NDArray[np.int64]:
+        """Index in frames of the frame of each row of data
+
+        Computed on first use and kept with the index (read-only).
+        """
+
+        positions = np.empty(len(self.order), dtype=np.int64)
+        positions[self.order] = np.repeat(np.arange(len(self.frames)), self.counts())
+        positions.flags.writeable = False
+        return positions
+
+
+@dataclass(frozen=True)
+class SegmentGrid:
+    """Uniform grid over the bounding boxes of trajectory segments
+
+    Segment i connects rows i and i + 1 of the sorted data (same agent).
+    The segments whose bounding box touches cell c are
+    segments[offsets[c] : offsets[c + 1]], cells are numbered row-wise.
+    """
+
+    origin: npt.NDArray[np.float64]
+    cell_size: float
+    shape: Tuple[int, int]  # cells in x and y
+    segments: npt.NDArray[np.int64]
+    offsets: npt.NDArray[np.int64]
+    num_segments: int
+
+    @classmethod
+    def from_sorted(
+        cls, data: npt.NDArray[np.float64], agents: AgentIndex, cells: int = 256
+    ) -> "SegmentGrid":
+        """Build grid with at most cells cells along the longer side"""
+
+        same_agent = np.ones(max(len(data) - 1, 0), dtype=bool)
+        same_agent[agents.offsets[1:-1] - 1] = False
+        seg = np.flatnonzero(same_agent)
+        if not seg.size:
+            return cls(
+                np.zeros(2), 1.0, (1, 1), seg.astype(np.int64), np.zeros(2, np.int64), 0
+            )
+
+        p0 = data[seg, 2:4]
+        p1 = data[seg + 1, 2:4]
+        lo = np.minimum(p0, p1)
+        hi = np.maximum(p0, p1)
+        del p0, p1
+        origin = lo.min(axis=0)
+        extent = hi.max(axis=0) - origin
+        cell_size = float(extent.max() / cells) or 1.0
+        nx, ny = (extent / cell_size).astype(np.int64) + 1
+        c0 = ((lo - origin) * (1 / cell_size)).astype(np.int64)
+        c1 = ((hi - origin) * (1 / cell_size)).astype(np.int64)
+        del lo, hi
+        np.minimum(c1, [nx - 1, ny - 1], out=c1)
+        # a segment is entered in every cell of its bounding box. Most
+        # segments are shorter than a cell and have only one entry
+        span_x = c1[:, 0] - c0[:, 0] + 1
+        span_y = c1[:, 1] - c0[:, 1] + 1
+        count = span_x * span_y
+        multi = np.flatnonzero(count > 1)
+        entry = np.repeat(multi, count[multi])
+        k = np.arange(len(entry)) - np.repeat(
+            np.cumsum(count[multi]) - count[multi], count[multi]
+        )
+        cx = c0[entry, 0] + k % span_x[entry]
+        cy = c0[entry, 1] + k // span_x[entry]
+        cell = np.concatenate((c0[:, 1] * nx + c0[:, 0], cy * nx + cx))
+        entry = np.concatenate((seg, seg[entry]))
+        cell[: len(seg)][count > 1] = nx * ny  # replaced by the expanded entries
+        order = np.argsort(cell, kind="stable")
+        counts = np.bincount(cell, minlength=nx * ny + 1)[: nx * ny]
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        return cls(
+            origin,
+            cell_size,
+            (int(nx), int(ny)),
+            entry[order[: offsets[-1]]].astype(np.int64),
+            offsets.astype(np.int64),
+            len(seg),
+        )
+
+    def query(
+        self, lo: npt.NDArray[np.float64], hi: npt.NDArray[np.float64]
+    ) -> npt.NDArray[np.int64]:
+        """Sorted segments whose cells touch the box [lo, hi]"""
+
+        nx, ny = self.shape
+        scale = 1 / self.cell_size
+        c0 = np.maximum(np.floor((np.asarray(lo) - self.origin) * scale), 0)
+        c1 = np.minimum(
+            np.floor((np.asarray(hi) - self.origin) * scale), [nx - 1, ny - 1]
+        )
+        if np.any(c0 > c1):
+            return self.segments[:0]
+
+        cx = np.arange(c0[0], c1[0] + 1, dtype=np.int64)
+        cy = np.arange(c0[1], c1[1] + 1, dtype=np.int64)
+        cells = (cy[:, np.newaxis] * nx + cx).ravel()
+        starts = self.offsets[cells]
+        lengths = self.offsets[cells + 1] - starts
+        index = np.arange(np.sum(lengths)) + np.repeat(
+            starts - (np.cumsum(lengths) - lengths), lengths
+        )
+        return np.unique(self.segments[index])
+
+
+@dataclass(frozen=True)
+class GridBins:
+    """Flat cell index of points on the grid with edges xbins, ybins
+
+    The bins are those of scipy.stats.binned_statistic_2d (the last edge
+    is included). Cell iy * nx + ix, so statistics reshaped to shape are
+    the transposed statistic of binned_statistic_2d. Points outside the
+    grid have cell num_cells and are left out of all statistics.
+    """
+
+    xbins: npt.NDArray[np.float64]
+    ybins: npt.NDArray[np.float64]
+    cell: npt.NDArray[np.int64]
+
+    @classmethod
+    def from_points(
+        cls,
+        X: npt.NDArray[np.float64],
+        Y: npt.NDArray[np.float64],
+        xbins: npt.NDArray[np.float64],
+        ybins: npt.NDArray[np.float64],
+    ) -> "GridBins":
+        ix, outside_x = GridBins._bin(xbins, X)
+        iy, outside_y = GridBins._bin(ybins, Y)
+        cell = iy * (len(xbins) - 1) + ix
+        cell[outside_x | outside_y] = (len(xbins) - 1) * (len(ybins) - 1)
+        return cls(xbins, ybins, cell)
+
+    @classmethod
+    def cached(
+        cls,
+        dataset: Any,
+        X: npt.NDArray[np.float64],
+        Y: npt.NDArray[np.float64],
+        xbins: npt.NDArray[np.float64],
+        ybins: npt.NDArray[np.float64],
+    ) -> "GridBins":
+        """from_points, computed once per dataset and grid (see cache.bins)"""
+
+        key = (dataset, xbins.tobytes(), ybins.tobytes())
+        bins = cache.bins.get(key)
+        if bins is None or len(bins.cell) != len(X):
+            bins = cls.from_points(X, Y, xbins, ybins)
+            cache.bins.put(key, bins)
+
+        return bins
+
+    @staticmethod
+    def _bin(
+        edges: npt.NDArray[np.float64], values: npt.NDArray[np.float64]
+    ) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.bool_]]:
+        index = np.searchsorted(edges, values, side="right") - 1
+        index[values == edges[-1]] = len(edges) - 2
+        return index, (index < 0) | (index >= len(edges) - 1)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.ybins) - 1, len(self.xbins) - 1
+
+    @property
+    def num_cells(self) -> int:
+        return self.shape[0] * self.shape[1]
+
+    def count(self) -> npt.NDArray[np.float64]:
+        """Number of points in each cell"""
+
+        counts = np.bincount(self.cell, minlength=self.num_cells + 1)
+        return counts[:-1].reshape(self.shape).astype(np.float64)
+
+    def statistic(
+        self, values: Optional[npt.NDArray[np.float64]], func: str
+    ) -> npt.NDArray[np.float64]:
+        """count, sum, mean, max or min of values in each cell (NaN if empty)
+
+        Like binned_statistic_2d(X, Y, values, func, [xbins, ybins]).statistic.T
+        """
+
+        if func == "count":
+            return self.count()
+
+        if func in ("sum", "mean"):
+            sums = np.bincount(self.cell, values, minlength=self.num_cells + 1)
+            sums = sums[:-1].reshape(self.shape)
+            if func == "sum":
+                return sums
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return sums / self.count()
+
+        if func in ("max", "min"):
+            ufunc = np.maximum if func == "max" else np.minimum
+            result = np.full(self.num_cells + 1, -np.inf if func == "max" else np.inf)
+            ufunc.at(result, self.cell, values)
+            result = result[:-1].reshape(self.shape)
+            result[self.count() == 0] = np.nan
+            return result
+
+        raise ValueError(f"Unknown statistic {func}")
+
+
+@dataclass(frozen=True)
+class MeasurementArea:
+    """Polygonal measurement area, vertices (in m) in polygon order"""
+
+    polygon: npt.NDArray[np.float64]
+
+    @classmethod
+    def from_rect(cls, x: List[float], y: List[float]) -> "MeasurementArea":
+        """Area from the corners of a drawn rectangle (see draw_geometry.process_rects)
+
+        The corners are top-left, top-right, bottom-left and bottom-right
+        of the (possibly rotated) rectangle.
+        """
+
+        return cls(np.column_stack((x, y))[[0, 1, 3, 2]])
+
+    @property
+    def size(self) -> float:
+        """Area of the polygon (shoelace formula)"""
+
+        x, y = self.polygon.T
+        return float(abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2)
+
+    @property
+    def centroid(self) -> npt.NDArray[np.float64]:
+        """Center of mass of the polygon"""
+
+        x, y = self.polygon.T
+        x1 = np.roll(x, -1)
+        y1 = np.roll(y, -1)
+        cross = x * y1 - x1 * y
+        if not cross.any():
+            return np.array(self.polygon.mean(axis=0))
+
+        return np.array([(x + x1) @ cross, (y + y1) @ cross]) / (3 * cross.sum())
+
+    @property
+    def sides(self) -> npt.NDArray[np.float64]:
+        """Length of the edges"""
+
+        return np.linalg.norm(np.roll(self.polygon, -1, axis=0) - self.polygon, axis=1)
+
+    def rows(
+        self, X: npt.NDArray[np.float64], Y: npt.NDArray[np.float64]
+    ) -> npt.NDArray[np.int64]:
+        """Indices of the points inside the polygon (even-odd rule)
+
+        Only the points in the bounding box are tested, vectorized over the
+        points for each edge.
+        """
+
+        xmin, ymin = self.polygon.min(axis=0)
+        xmax, ymax = self.polygon.max(axis=0)
+        candidates = np.flatnonzero(
+            (X >= xmin) & (X <= xmax) & (Y >= ymin) & (Y <= ymax)
+        )
+        x = X[candidates]
+        y = Y[candidates]
+        inside = np.zeros(len(candidates), dtype=bool)
+        for (x1, y1), (x2, y2) in zip(self.polygon, np.roll(self.polygon, -1, axis=0)):
+            if y1 == y2:
+                continue
+
+            crosses = (y1 > y) != (y2 > y)
+            inside ^= crosses & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+
+        return candidates[inside]
+
+    def cached_rows(
+        self, dataset: Any, X: npt.NDArray[np.float64], Y: npt.NDArray[np.float64]
+    ) -> npt.NDArray[np.int64]:
+        """rows, computed once per dataset and polygon (see cache.areas)"""
+
+        key = (dataset, self.polygon.tobytes())
+        rows = cache.areas.get(key)
+        if rows is None:
+            rows = self.rows(X, Y)
+            cache.areas.put(key, rows)
+
+        return rows
+
+    def cached_gauss_series(
+        self,
+        dataset: Any,
+        positions: npt.NDArray[np.int64],
+        num_frames: int,
+        X: npt.NDArray[np.float64],
+        Y: npt.NDArray[np.float64],
+        width: float,
+    ) -> npt.NDArray[np.float64]:
+        """Gaussian density series at the centroid (see Utilities.gauss_time_series)
+
+        Computed once per dataset, polygon and width (see cache.areas).
+        """
+
+        key = (dataset, self.polygon.tobytes(), "gauss", width)
+        series = cache.areas.get(key)
+        if series is None:
+            series = Utilities.gauss_time_series(
+                positions, num_frames, X, Y, *self.centroid, width
+            )
+            cache.areas.put(key, series)
+
+        return series
+
+
+@dataclass
+class LazyDataFrame:
+    """DataFrame on the first len(columns) columns of data, built on first use
+
+    The frame is a view on data (no copy), so it must not be modified.
+    """
+
+    data: npt.NDArray[np.float64]
+    columns: List[str]
+    _df: Optional[pd.DataFrame] = field(init=False, default=None)
+
+    def get(self) -> pd.DataFrame:
+        if self._df is None:
+            self._df = pd.DataFrame(
+                self.data[:, : len(self.columns)], columns=self.columns, copy=False
+            )
+
+        return self._df
+
+
+@dataclass(frozen=True)
+class TrajHeader:
+    """Metadata from the leading comment block of a trajectory file"""
+
+    fps: int
+    unit: str
+    columns: List[str]
+    header: str  # line with the column names
+    speed_index: int  # -1 if not existing
+    group_index: int  # -1 if not existing
+    source: str  # jpscore, petrack or unknown
+    geometry: str
+
+    @classmethod
+    def from_stream(cls, stream: BinaryIO, max_bytes: int = 1 << 16) -> "TrajHeader":
+        """Parse the comment lines at the start of stream
+
+        Only the header (at most max_bytes) is read, the data lines are not
+        touched. The stream is rewound afterwards.
+        """
+
+        stream.seek(0)
+        lines = []
+        size = 0
+        while size < max_bytes:
+            line = stream.readline()
+            if not line or not (line.startswith(b"#") or not line.strip()):
+                break
+
+            lines.append(line)
+            size += len(line)
+
+        stream.seek(0)
+        text = b"".join(lines).decode("utf-8", errors="replace")
+        header = Utilities.get_header(text)
+        columns = header.lstrip("#").split() if header.startswith("#") else []
+        if Utilities.detect_jpscore(text):
+            source = "jpscore"
+        elif "petrack" in text.lower():
+            source = "petrack"
+        else:
+            source = "unknown"
+
+        return cls(
+            fps=Utilities.get_fps(text),
+            unit=Utilities.get_unit(text),
+            columns=columns,
+            header=header,
+            speed_index=Utilities.get_speed_index(text),
+            group_index=Utilities.get_index_group(text),
+            source=source,
+            geometry=Utilities.get_geometry_file(text) if "geometry:" in text else "",
+        )
+
+
+@dataclass(frozen=True)
+class Geometry:
+    """Walls, obstacles, transitions and measurement lines of a geometry file
+
+    Vertices are in m. Walls are all polygons of the subrooms (numbered
+    from 1), measurement lines (area_L) are merged into transitions.
+    Bounding boxes (area_B with 4 vertices) are ordered by angle, since
+    their vertices are not always written in polygon order.
+    """
+
+    walls: Dict[int, npt.NDArray[np.float64]]
+    obstacles: Dict[int, npt.NDArray[np.float64]]
+    transitions: Dict[Union[str, int], npt.NDArray[np.float64]]
+    bounds: Tuple[float, float, float, float]  # xmin, xmax, ymin, ymax
+    # measurement areas (area_B) as polygons
+    areas: Dict[Union[str, int], npt.NDArray[np.float64]] = field(default_factory=dict)
+
+    @classmethod
+    def from_xml(cls, source: Union[str, BinaryIO], unit: str = "m") -> "Geometry":
+        """Parse geometry in one pass over the xml elements"""
+
+        cm2m = 100 if unit == "cm" else 1
+        walls = {}
+        obstacles = {}
+        transitions: Dict[Union[str, int], npt.NDArray[np.float64]] = {}
+        measurement_lines: Dict[Union[str, int], npt.NDArray[np.float64]] = {}
+        areas: Dict[Union[str, int], npt.NDArray[np.float64]] = {}
+        fake_id = 1000
+        subroom_depth = 0
+        obstacle_points: List[Tuple[float, float]] = []
+        vertices: List[Tuple[float, float]] = []
+        line: List[Tuple[float, float]] = []
+        for event, elem in ET.iterparse(source, events=("start", "end")):
+            tag = elem.tag
+            if event == "start":
+                if tag == "subroom":
+                    subroom_depth += 1
+                elif tag in ("polygon", "transition", "area_B"):
+                    vertices = []
+                elif tag == "obstacle":
+                    obstacle_points = []
+                elif tag == "area_L":
+                    line = []
+
+                continue
+
+            if tag == "vertex":
+                vertices.append((float(elem.get("px")), float(elem.get("py"))))
+            elif tag in ("start", "end"):
+                line.append((float(elem.get("px")), float(elem.get("py"))))
+            elif tag == "polygon":
+                obstacle_points.extend(vertices)
+                if subroom_depth:
+                    walls[len(walls) + 1] = np.array(vertices).reshape(-1, 2) / cm2m
+            elif tag == "obstacle":
+                obstacles[len(obstacles)] = sort_by_angle(
+                    np.array(obstacle_points).reshape(-1, 2) / cm2m
+                )
+            elif tag == "transition":
+                transitions[elem.get("id", "")] = (
+                    np.array(vertices).reshape(-1, 2) / cm2m
+                )
+            elif tag == "area_L":
+                Id: Union[str, int] = elem.get("id", "")
+                if Id == "":
+                    st.warning(
+                        f"Got Measurement line with no Id. Setting id = {fake_id}"
+                    )
+                    logging.info(
+                        f"Got Measurement line with no Id. Setting id = {fake_id}"
+                    )
+                    Id = fake_id
+                    fake_id += 1
+
+                measurement_lines[Id] = np.array(line[:2]) / cm2m
+            elif tag == "area_B":
+                polygon = np.array(vertices).reshape(-1, 2) / cm2m
+                if len(polygon) == 4:
+                    polygon = sort_by_angle(polygon)
+
+                if len(polygon) >= 3:
+                    areas[elem.get("id", str(len(areas) + 1))] = polygon
+            elif tag == "subroom":
+                subroom_depth -= 1
+
+            elem.clear()
+
+        if not walls:
+            raise ValueError("Geometry has no walls")
+
+        # todo: check if ids of transitions and measurement_lines are unique
+        transitions.update(measurement_lines)
+        points = np.vstack(list(walls.values()))
+        xmin, ymin = np.min(points, axis=0)
+        xmax, ymax = np.max(points, axis=0)
+        return cls(walls, obstacles, transitions, (xmin, xmax, ymin, ymax), areas)
+
+
+def sort_by_angle(points: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    """Unique points ordered by their angle around the center"""
+
+    points = np.unique(points, axis=0)
+    if not len(points):
+        return points
+
+    center = np.mean(points, axis=0)
+    angles = np.arctan2(points[:, 0] - center[0], points[:, 1] - center[1])
+    return points[np.argsort(angles, kind="stable")]
+
+
+# parsed geometries by content hash, shared by all sessions
+_geometries: Dict[str, Geometry] = {}
 
 
 @dataclass
@@ -23,12 +683,20 @@ class data_files:  # todo: split data in TrajData vs GeoData
     uploaded_traj_file: UploadedFile
     uploaded_geo_file: UploadedFile
     from_examples: str
+    # float32 instead of float64: half the memory. ID and FR are exact up to 2^24
+    compact: bool = False
     traj_name: str = field(init=False, default="")
     selected_traj_file: str = field(init=False, default="")
     selected_geo_file: str = field(init=False, default="")
     got_traj_data: Any = field(init=False, default=False)
-    _data: npt.NDArray[np.float32] = field(init=False, default=np.array([]))
-    _df: pd.DataFrame = field(init=False)
+    header: TrajHeader = field(init=False)
+    traj_digest: str = field(init=False, default="")
+    from_cache: bool = field(init=False, default=False)
+    _data: npt.NDArray[np.float32] = field(
+        init=False, default_factory=lambda: np.array([])
+    )
+    _agents: AgentIndex = field(init=False)
+    _frame_index: FrameIndex = field(init=False)
     _header: List[str] = field(init=False)
     default_geometry_file: str = (
         "geometry.xml"  # in case trajectories have no geometry files
@@ -37,38 +705,48 @@ class data_files:  # todo: split data in TrajData vs GeoData
     def get_data(self):
         return self._data
 
-    def get_data_df(self):
-        return self._df
+    def get_columns(self) -> List[str]:
+        return self._header
+
+    def get_agents(self) -> AgentIndex:
+        return self._agents
 
-    def process_traj_file(self) -> str:
-        """return StringIO data from trajectory file"""
+    def get_frame_index(self) -> FrameIndex:
+        return self._frame_index
+
+    def read_header(self) -> TrajHeader:
+        """Return metadata from the header of the trajectory file"""
         if self.uploaded_traj_file:
-            stringio = StringIO(self.uploaded_traj_file.getvalue().decode("utf-8"))
-            string_data = stringio.read()
-        else:
-            with open(self.selected_traj_file, encoding="utf-8") as f:
-                string_data = f.read()
+            return TrajHeader.from_stream(self.uploaded_traj_file)
 
-        logging.info("got some data")
-        return string_data
+        with open(self.selected_traj_file, "rb") as f:
+            return TrajHeader.from_stream(f)
 
-    def process_geo_file(self) -> str:
-        """return data from geometry file"""
-        if self.uploaded_geo_file is None:
-            with open(
-                self.default_geometry_file, encoding="utf-8"
-            ) as geometry_file_obj:
-                geo_string_data = geometry_file_obj.read()
+    def read_trajectory(self) -> npt.NDArray[np.float64]:
+        """Parse the trajectory file in chunks (see Utilities.read_trajectory)"""
+        dtype = np.float32 if self.compact else np.float64
+        if self.uploaded_traj_file:
+            return Utilities.read_trajectory(self.uploaded_traj_file, dtype=dtype)
 
-        else:
-            geo_stringio = StringIO(self.uploaded_geo_file.getvalue().decode("utf-8"))
-            geo_string_data = geo_stringio.read()
+        return Utilities.read_trajectory(self.selected_traj_file, dtype=dtype)
+
+    def traj_fingerprint(self) -> str:
+        """Return content hash of the trajectory file"""
+        if self.uploaded_traj_file:
+            return Utilities.upload_fingerprint(self.uploaded_traj_file)
+
+        return Utilities.file_fingerprint(self.selected_traj_file)
 
-        if self.selected_geo_file:
-            with open(self.selected_geo_file, encoding="utf-8") as geometry_file_obj:
-                geo_string_data = geometry_file_obj.read()
+    def geo_fingerprint(self) -> str:
+        """Return content hash of the geometry file parsed by read_geometry"""
+        if self.uploaded_geo_file:
+            return Utilities.upload_fingerprint(self.uploaded_geo_file)
 
-        return geo_string_data
+        geo_file = self.selected_geo_file or self.default_geometry_file
+        if not Path(geo_file).exists():
+            return ""
+
+        return Utilities.file_fingerprint(geo_file)
 
     def init_header(self):
 
@@ -93,28 +771,56 @@ class data_files:  # todo: split data in TrajData vs GeoData
             self._header = ["ID", "FR", "X", "Y", "Z"]
 
     def read_traj_data(self):
-        """Set _data with trajectories if traj file uploaded or selected"""
+        """Set _data with trajectories if traj file uploaded or selected
+
+        This parses (or memory-maps) the whole file, so it is only called
+        when a new dataset is selected, not on every rerun.
+        """
         logging.info(f"Got data: {self.got_traj_data}")
         if self.got_traj_data:
-            self._data = read_csv(
-                self.got_traj_data, sep=r"\s+", dtype=np.float64, comment="#"
-            ).values
-
-    def read_geo_data(self) -> Document:
-        """Return xml object from geoemtry file"""
-        logging.info(f"geo: {self.uploaded_traj_file}")
-        geo_xml = None
-        if self.uploaded_geo_file:
-            geo_xml = parseString(self.uploaded_geo_file.getvalue())
+            name = "trajectories_float32" if self.compact else "trajectories"
+            data = cache.load_array(self.traj_digest, name)
+            self.from_cache = data is not None
+            if data is None:
+                data = self.read_trajectory()
+                if self.compact and data.size and np.max(data[:, :2]) >= 2**24:
+                    logging.warning("IDs or frames too large for float32")
+                    self.compact = False
+                    data = data.astype(np.float64)
+                    name = "trajectories"
 
-        elif self.selected_geo_file:
-            geo_xml = parse(self.selected_geo_file)
+                data = sort_trajectories(data)
+                cache.store_array(self.traj_digest, name, data)
 
+            self._data = data
+            self._agents = AgentIndex.from_sorted(self._data)
+            self._frame_index = FrameIndex.from_data(self._data)
+            Utilities.touch_default_geometry_file(
+                self._data, self.header.unit, self.default_geometry_file
+            )
+            self.init_header()
+
+    def read_geometry(self) -> Geometry:
+        """Return parsed geometry, cached by content hash"""
+        digest = self.geo_fingerprint()
+        if digest in _geometries:
+            logging.info(f"Geometry cache hit: {digest}")
+            return _geometries[digest]
+
+        if self.uploaded_geo_file:
+            self.uploaded_geo_file.seek(0)
+            geometry = Geometry.from_xml(self.uploaded_geo_file)
+            self.uploaded_geo_file.seek(0)
         else:
-            if Path(self.default_geometry_file).exists():
-                geo_xml = parse(self.default_geometry_file)
+            geometry = Geometry.from_xml(
+                self.selected_geo_file or self.default_geometry_file
+            )
 
-        return geo_xml  # type: ignore
+        if len(_geometries) >= 16:
+            _geometries.clear()
+
+        _geometries[digest] = geometry
+        return geometry
 
     # todo: return shapely
 
@@ -135,12 +841,7 @@ class data_files:  # todo: split data in TrajData vs GeoData
         if self.selected_traj_file:
             self.traj_name = self.selected_traj_file.split(".txt", maxsplit=1)[0]
 
-        self.read_traj_data()
+        # cheap on reruns: the digest is memoized and only the header is read
         if self.got_traj_data:
-            Utilities.touch_default_geometry_file(
-                self._data, st.session_state.unit, self.default_geometry_file
-            )
-            self.init_header()
-            self._df = pd.DataFrame(self._data, columns=self._header)
-
-        self.read_geo_data()
+            self.traj_digest = self.traj_fingerprint()
+            self.header = self.read_header()
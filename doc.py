@@ -31,6 +31,13 @@ def doc_plots():
     \end{equation}
     """
     )
+    st.write(
+        r"""
+    The flow in sliding windows counts the $N_w(t)$ pedestrians passing the line
+    in the last $w$ seconds, $J_w(t) = N_w(t) / w$, for each selected window size $w$.
+    The legend shows mean and standard deviation of $J_w$.
+    """
+    )
 
     st.write(
         """
@@ -191,7 +198,8 @@ def doc_speed():
 def doc_timeseries():
     st.write(
         """
-    Time series of the density and the speed are calculated within a measurement rectangle with side lengths $dx$ and $dy$.
+    Time series of the density and the speed are calculated within measurement areas:
+    the drawn (and possibly rotated) rectangles and the polygons `area_B` of the geometry file.
 
     Density and speed are calculated as defined in `Profiles`, whereas flow is defined as:
     """
@@ -204,8 +212,11 @@ def doc_timeseries():
     )
     st.write(
         """
-        where $l$ is a constant between $dx$ and $dy$.
+        where $l$ is a constant between the shortest and the longest side of the area.
         
+    With the method `Gaussian`, the density field is evaluated at the centroid of the area
+    and the speed follows from the density by the Weidmann formula.
+
     Depending on the frames per seconds of the trajectories, it might be better to increase the sampling rate
     (`sample`) to speed up rendering the plots.
     """
@@ -12,7 +12,8 @@ import streamlit as st
 from PIL import Image
 from streamlit_drawable_canvas import st_canvas
 
-from Utilities import get_time, get_unit, read_trajectory
+from data_structure import AgentIndex, TrajHeader, sort_trajectories
+from Utilities import get_time, read_trajectory, upload_fingerprint
 
 download_pl = st.empty()
 debug = st.sidebar.checkbox("Show", help="plot result with ticks and show xml")
@@ -44,10 +45,9 @@ def get_scaled_dimensions(geominX, geomaxX, geominY, geomaxY):
     return w, h, scale
 
 
-def plot_traj(ax, data, scale=1, shift_x=0, shift_y=0):
-    pid = np.unique(data[:, 0])
-    for ped in pid:
-        pedd = data[data[:, 0] == ped]
+def plot_traj(ax, data, agents, scale=1, shift_x=0, shift_y=0):
+    for _, rows in agents:
+        pedd = data[rows]
         ax.plot(
             (pedd[::, 2] - shift_x) * scale,
             (pedd[::, 3] - shift_y) * scale,
@@ -269,17 +269,16 @@ def write_geometry(
 def main(trajectory_file):
     geo_file = ""
 
-    stringio = io.StringIO(trajectory_file.getvalue().decode("utf-8"))
-    string_data = stringio.read()
-    if string_data != st.session_state.old_data:
-        st.session_state.old_data = string_data
+    traj_digest = upload_fingerprint(trajectory_file)
+    if traj_digest != st.session_state.traj_digest:
+        st.session_state.traj_digest = traj_digest
         new_data = True
         logging.info("Loading new trajectory data")
     else:
         logging.info("Trajectory data existing")
         new_data = False
 
-    unit = get_unit(string_data)
+    unit = TrajHeader.from_stream(trajectory_file).unit
     logging.info(f"unit {unit}")
     if unit not in ["cm", "m"]:
         st.error(f"did not recognize unit from file: {unit}")
@@ -299,10 +298,12 @@ def main(trajectory_file):
 
     st.sidebar.write("----")
     if new_data:
-        data = read_trajectory(trajectory_file) / cm2m
+        data = sort_trajectories(read_trajectory(trajectory_file) / cm2m)
+        agents = AgentIndex.from_sorted(data)
         geominX, geomaxX, geominY, geomaxY = get_dimensions(data)
         width, height, scale = get_scaled_dimensions(geominX, geomaxX, geominY, geomaxY)
         st.session_state.data = data
+        st.session_state.agents = agents
         # setup background figure
         fig, ax = plt.subplots(figsize=(width, height))
         fig.set_dpi(100)
@@ -311,7 +312,7 @@ def main(trajectory_file):
         plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
         inv = ax.transData.inverted()
         # st.info(f"width: {img_width}, height: {img_height}")
-        plot_traj(ax, data, scale, geominX, geominY)
+        plot_traj(ax, data, agents, scale, geominX, geominY)
         major_ticks_top_x = np.linspace(0, width, 5)
         major_ticks_top_y = np.linspace(0, height, 5)
         minor_ticks_top_x = np.linspace(0, width, 40)
@@ -411,7 +412,7 @@ def main(trajectory_file):
                 ax2.set_xlim((geominX, geomaxX))
                 ax2.set_ylim((geominY, geomaxY))
                 ax2.grid(alpha=0.3)
-                plot_traj(ax2, data)
+                plot_traj(ax2, data, st.session_state.agents)
                 st.session_state.fig2 = fig2
                 st.session_state.ax2 = ax2
                 st.session_state.first_plot_traj = True
@@ -574,12 +575,15 @@ def main(trajectory_file):
 
 
 def set_state_variables():
-    if "old_data" not in st.session_state:
-        st.session_state.old_data = ""
+    if "traj_digest" not in st.session_state:
+        st.session_state.traj_digest = ""
 
     if "data" not in st.session_state:
         st.session_state.data = np.array([])
 
+    if "agents" not in st.session_state:
+        st.session_state.agents = None
+
     if "unit" not in st.session_state:
         st.session_state.unit = "m"
 
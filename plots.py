@@ -12,8 +12,9 @@ import streamlit as st
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from plotly.subplots import make_subplots
 from scipy import spatial, stats
-from shapely.geometry import Point
 
+from data_structure import AgentIndex
+import Utilities
 from Utilities import survival
 
 
@@ -222,11 +223,53 @@ def plot_flow(
     return fig
 
 
+def plot_flow_series(
+    times: npt.NDArray[np.float64],
+    J: dict,
+    J_mean: dict,
+    J_std: dict,
+    windows: List[float],
+) -> go.Figure:
+    """return figure object for the flow in sliding windows
+
+    :param times: time of each value of J
+    :param J: flow (windows x times) of each transition, see Utilities.flow_series
+    :param J_mean: mean flow of each transition and window
+    :param J_std: std of the flow of each transition and window
+    :param windows: window sizes in seconds
+    :returns: go.Figure
+
+    """
+    logging.info("plot flow series")
+    fig = make_subplots(
+        rows=1,
+        cols=1,
+        subplot_titles=["<b>Flow in sliding windows</b>"],
+        x_title="Time / s",
+        y_title="J / 1/s",
+    )
+    for i, flows in J.items():
+        for k, window in enumerate(windows):
+            trace = go.Scatter(
+                x=times,
+                y=flows[k],
+                mode="lines",
+                showlegend=True,
+                name=f"ID: {i}, {window} s: {J_mean[i][k]:.2f} ± {J_std[i][k]:.2f}",
+                line=dict(width=2),
+            )
+            fig.append_trace(trace, row=1, col=1)
+
+    fig.update_layout(hovermode="x")
+    return fig
+
+
 @st.cache(suppress_st_warning=True, hash_funcs={go.Figure: lambda _: None})
 def plot_time_distance(
     _frames: npt.NDArray[np.int64],
     data: npt.NDArray[np.float64],
-    line: List[float],
+    agents: AgentIndex,
+    line: npt.NDArray[np.float64],
     trans_num: int,
     fps: int,
     num_peds: int,
@@ -239,8 +282,10 @@ def plot_time_distance(
     :type _frames: npt.NDArray[np.int64]
     :param data:
     :type data: npt.NDArray[np.float64]
-    :param line:
-    :type line: List[float]
+    :param agents:
+    :type agents: AgentIndex
+    :param line: points of the transition
+    :type line: npt.NDArray[np.float64]
     :param trans_num:
     :type trans_num: int
     :param fps:
@@ -256,11 +301,10 @@ def plot_time_distance(
     """
     frames_initial_speed_mean = 4 * fps  # Adrian2020a 4 s
     logging.info("plot time_distance curve")
-    peds = _frames[:, 0].astype(int)
     num_peds = int(num_peds)
     sample = int(sample)
-    frames = _frames[:, 1]
-    peds = peds[:num_peds]
+    peds = _frames[:num_peds, 0].astype(np.int64)
+    frames = _frames[:num_peds, 1]
     fig = make_subplots(
         rows=1,
         cols=1,
@@ -270,53 +314,56 @@ def plot_time_distance(
         x_title="Distance to entrance / m",
         y_title="Time to entrance / s",
     )
-    xstart = []
-    ystart = []
-    colors = []
-    ped_group = group_index
-    for p, toframe in zip(peds, frames):
-        ff = data[np.logical_and(data[:, 1] <= toframe, data[:, 0] == p)]
-        ped_group = data[data[:, 0] == p][0, group_index]
-        if ped_group == 1:
-            color = "blue"
-        elif ped_group == 2:
-            color = "red"
-        elif ped_group == 3:
-            color = "green"
+    # rows of each agent until it passes the line, every sample-th row
+    start, stop = agents.spans_until(data, peds, frames)
+    num_rows = -(-(stop - start) // sample)
+    passed = num_rows > 0
+    start, stop, num_rows = start[passed], stop[passed], num_rows[passed]
+    frames = frames[passed]
+    offsets = np.cumsum(num_rows) - num_rows
+    # one row for the NaN separator after each agent
+    agent = np.repeat(np.arange(len(start)), num_rows)
+    step = np.arange(len(agent)) - offsets[agent]
+    rows = start[agent] + sample * step
+    position = np.arange(len(agent)) + agent
+    xx = np.full(len(agent) + len(start), np.nan)
+    yy = np.full(len(agent) + len(start), np.nan)
+    xx[position] = Utilities.distance_to_line(data[rows, 2:4], np.asarray(line))
+    yy[position] = (frames[agent] - data[rows, 1]) / fps
+    separators = offsets + num_rows + np.arange(len(start))
+    groups = data[start, group_index]
+    for ped_group, color in [(1, "blue"), (2, "red"), (3, "green"), (None, "black")]:
+        if ped_group is None:
+            in_group = ~np.isin(groups, [1, 2, 3])
         else:
-            color = "black"
-
-        speed = np.mean(ff[:frames_initial_speed_mean, st.session_state.speed_index])
-        sc = speed
-        xx = []
-        yy = []
-        for frame, x, y in ff[::sample, 1:4]:
-            pos = Point(x, y)
-            dx = pos.distance(line)
-            dt = (toframe - frame) / fps
-            xx.append(dx)
-            yy.append(dt)
-
-        xstart.append(xx[0])
-        ystart.append(yy[0])
-        colors.append(sc)
+            in_group = groups == ped_group
+
+        if not in_group.any():
+            continue
 
+        points = np.concatenate((position[in_group[agent]], separators[in_group]))
+        points.sort()
         trace = go.Scatter(
-            x=xx,
-            y=yy,
+            x=xx[points],
+            y=yy[points],
             mode="lines",
-            name=f"Agent: {p:.0f}",
+            name=f"Group: {ped_group}" if ped_group else "Agents",
             showlegend=False,
             line=dict(width=0.3, color=color),
         )
         fig.append_trace(trace, row=1, col=1)
 
+    # mean speed in the first 4 s (before passing the line)
+    initial = start[:, np.newaxis] + np.arange(frames_initial_speed_mean)
+    in_range = initial < stop[:, np.newaxis]
+    speeds = data[np.minimum(initial, len(data) - 1), st.session_state.speed_index]
+    colors = np.sum(speeds * in_range, axis=1) / np.sum(in_range, axis=1)
     trace_start = go.Scatter(
-        x=xstart,
-        y=ystart,
+        x=xx[offsets + np.arange(len(start))],
+        y=yy[offsets + np.arange(len(start))],
         mode="markers",
         showlegend=False,
-        name=f"Group: {ped_group:.0f}",
+        name="Start",
         marker=dict(
             size=5,
             color=colors,
@@ -536,7 +583,7 @@ def plot_timeserie(frames, t, fps, title, miny, maxy, liney=None):
     # plot line
     if liney is not None:
         trace1 = go.Scatter(
-            x=[times[0], times[len(t)]],
+            x=[times[0], times[-1]],
             y=[liney, liney],
             name=f"Max Profile {title}",
             mode="lines",
@@ -686,6 +733,7 @@ def plot_agent_speed(pid, frames, speed_agent, max_speed, fps):
 
 def moving_trajectories(
     data,
+    agents,
     data_df,
     special_ped,
     speed,
@@ -699,21 +747,26 @@ def moving_trajectories(
     sample_trajectories,
 ):
     logging.info("visualisation trajectories")
+    # data_df is a read-only view shared between reruns.
+    # Derived sizes and colors are passed as separate arrays
+    num_rows = len(data_df)
     if "SPEED" in data_df.columns:
-        color = "SPEED"
-        range_color = [0, max(data_df["SPEED"])]
+        color_name = "SPEED"
+        color = data_df["SPEED"]
+        range_color = [0, data_df["SPEED"].max()]
     elif "COLOR" in data_df.columns:
-        color = "COLOR"
+        color_name = "COLOR"
+        color = data_df["COLOR"]
         range_color = [0, 255]
     else:
-        data_df["COLOR"] = 125
-        color = "COLOR"
+        color_name = "COLOR"
+        color = np.full(num_rows, 125)
         range_color = [0, 125]
 
     if "A" in data_df:
-        data_df["A"] /= 2
+        size = data_df["A"].to_numpy() / 2
     else:
-        data_df["A"] = 0.2
+        size = np.full(num_rows, 0.2)
 
     fig = px.scatter(
         data_df,
@@ -722,13 +775,14 @@ def moving_trajectories(
         animation_frame="FR",
         animation_group="ID",
         color=color,
-        size="A",
+        size=size,
         range_color=range_color,
+        labels={"color": color_name, "size": "A"},
         color_continuous_scale=px.colors.diverging.RdBu_r[::-1],
     )
 
     if special_ped > 0:
-        s = data[data[:, 0] == special_ped]
+        s = agents.rows(data, special_ped)
         sc = speed / np.max(speed)
 
         trace_agent = go.Scatter(
@@ -821,6 +875,7 @@ def moving_trajectories(
 @st.cache(suppress_st_warning=True, hash_funcs={go.Figure: lambda _: None})
 def plot_trajectories(
     data,
+    agents,
     special_ped,
     speed,
     geo_walls,
@@ -837,9 +892,8 @@ def plot_trajectories(
         rows=1,
         cols=1,
     )
-    peds = np.unique(data[:, 0])
-    for ped in peds:
-        d = data[data[:, 0] == ped]
+    for ped, rows in agents:
+        d = data[rows]
         trace_traj = go.Scatter(
             x=d[::sample_trajectories, 2],
             y=d[::sample_trajectories, 3],
@@ -851,7 +905,7 @@ def plot_trajectories(
         fig.append_trace(trace_traj, row=1, col=1)
 
     if special_ped > 0:
-        s = data[data[:, 0] == special_ped]
+        s = agents.rows(data, special_ped)
         sc = speed / np.max(speed)
 
         trace_agent = go.Scatter(
@@ -944,7 +998,7 @@ def plot_geometry(ax, _geometry_wall):
 @st.cache(
     suppress_st_warning=True, hash_funcs={matplotlib.figure.Figure: lambda _: None}
 )
-def plot_profile_and_geometgry2(
+def plot_profile_and_geometry2(
     xbins,
     ybins,
     geometry_wall,
@@ -1108,7 +1162,8 @@ def plot_survival(Frames, fps):
             continue
 
         times = np.array(frames) / fps
-        y, dif = survival(times)
+        # the log axis does not need more points than pixels
+        y, dif = survival(times, unique=True, log_bins=200 if frames.size > 1000 else 0)
         trace = go.Scatter(
             x=dif,
             y=y,